@@ -1,11 +1,11 @@
 from telegram.ext import (
     ContextTypes,
     Application,
-    PicklePersistence,
     filters,
     CommandHandler,
     MessageHandler,
     Defaults,
+    JobQueue,
 )
 from telegram import Update, LinkPreviewOptions
 from telegram.error import BadRequest
@@ -14,10 +14,31 @@ import asyncio
 from datetime import datetime, timedelta
 import pytz
 from custom_context import RedditContext
+from reddit_types import RedditSubmission
 import traceback
 from os import getenv
 from ratelimiter import RateLimiter
+from http_client import open_client, close_client
 from collections import defaultdict
+from copy import copy
+from functools import partial
+import time
+from cycle_stats import CycleStats
+from metrics import (
+    listing_fetch_seconds,
+    media_type,
+    metrics_server,
+    prepare_seconds,
+    registry,
+    send_seconds,
+    submissions_failed,
+    submissions_sent,
+)
+from prefetch import Preparer
+from scheduling import PosterSchedule, listing_key, plan_listings, plan_schedules
+from reddit_ratelimit import governor
+from stores import SentSubmissions, SubredditInfoCache
+from sqlite_persistence import SQLitePersistence
 from base_posters import Poster, NSFWPoster, get_channel_posters
 import dotenv
 
@@ -36,6 +57,25 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 channel_posters = get_channel_posters()
 
+CHANNEL_CONCURRENCY = int(getenv("CHANNEL_CONCURRENCY") or 4)
+LISTING_CONCURRENCY = int(getenv("LISTING_CONCURRENCY") or 4)
+PREPARE_CONCURRENCY = int(getenv("PREPARE_CONCURRENCY") or 4)
+PREPARE_QUEUE_SIZE = int(getenv("PREPARE_QUEUE_SIZE") or 20)
+PREFETCH_LEAD_MINUTES = float(getenv("PREFETCH_LEAD_MINUTES") or 2)
+INCREMENTAL_LISTINGS = (getenv("INCREMENTAL_LISTINGS") or "1") not in ("0", "false")
+SENT_SUBMISSIONS_MAX_COUNT = int(getenv("SENT_SUBMISSIONS_MAX_COUNT") or 5000)
+SENT_SUBMISSIONS_MAX_AGE_DAYS = float(getenv("SENT_SUBMISSIONS_MAX_AGE_DAYS") or 30)
+SUBREDDIT_INFO_TTL_HOURS = float(getenv("SUBREDDIT_INFO_TTL_HOURS") or 24)
+
+# shared by all the jobs, so that two of them never send to the same chat at once
+chat_locks: defaultdict[str | int, asyncio.Lock] = defaultdict(asyncio.Lock)
+preparer = Preparer(PREPARE_CONCURRENCY, PREPARE_QUEUE_SIZE)
+# listings fetched by prefetch_channel, waiting for the run of their schedule;
+# they were fetched with that schedule's cursors, so no other run may use them
+staged_listings: dict[
+    tuple[str, tuple[str, str]], tuple[float, int, tuple[list[dict], dict | None]]
+] = {}
+
 
 def datetime_round(dt: datetime, minutes: int) -> datetime:
     minutes_delta = timedelta(minutes=minutes)
@@ -52,10 +92,10 @@ async def reddit_post(update: Update, context: RedditContext):
     if not context.args:
         await update.effective_message.reply_text("Syntax:\n/reddit <post_id>")
         return
-    nsfw = await context.all_subreddits_nsfw(context.args[0])
-    submissions = await context.get_submission_raw(context.args[0])
+    submission = await context.get_submission_raw(context.args[0])
+    nsfw = await context.all_subreddits_nsfw(submission["subreddit"])
     await send_reddit(
-        update.effective_chat.id, submissions, context, NSFWPoster if nsfw else Poster
+        update.effective_chat.id, submission, context, NSFWPoster if nsfw else Poster
     )
 
 
@@ -79,37 +119,283 @@ async def reddit_posts(update: Update, context: RedditContext):
 
 
 async def reddit_on_channel(context: RedditContext):
-    for poster in channel_posters:
-        for submission in await context.get_subreddit_submissions_raw(
-            poster.subreddits, poster.limit, poster.sort_by
-        ):
-            if (
-                submission["id"]
-                not in context.bot_data["sent_submissions"][poster.chat]
-            ):
-                await send_reddit(poster.chat, submission, context, poster)
-                context.bot_data["sent_submissions"][poster.chat].append(
-                    submission["id"]
+    schedule: PosterSchedule = context.job.data
+    new_submissions = 0
+    try:
+        new_submissions = await run_channel_cycle(
+            context, schedule.posters, schedule.name
+        )
+    finally:
+        if schedule.adaptive:
+            previous = schedule.interval
+            schedule.adapt(new_submissions)
+            if schedule.interval != previous:
+                logging.info(
+                    f"{schedule.name} now runs every {schedule.interval:.0f} minutes"
                 )
-                await asyncio.sleep(5)
+            # adaptive schedules reschedule themselves after every run
+            schedule_run(context.job_queue, schedule, schedule.interval * 60)
 
 
-async def send_reddit(
-    chat_id: str | int, submission: dict, context: RedditContext, poster: type[Poster]
+async def prefetch_channel(context: RedditContext):
+    """Lists the posters' subreddits a bit before they run and starts preparing
+    the new submissions, so that the run itself only has to send them"""
+    schedule: PosterSchedule = context.job.data
+    listings = plan_listings(schedule.posters)
+    results = await asyncio.gather(
+        *(
+            fetch_listing(context, key, limit, schedule.name)
+            for key, limit in listings.items()
+        ),
+        return_exceptions=True,
+    )
+    prefetched: set[str] = set()
+    for (key, limit), listing in zip(listings.items(), results):
+        if isinstance(listing, Exception):
+            logging.warning(f"Prefetching {key} failed: {listing!r}")
+            continue
+        # the cursor is stored by the run, once the submissions have been sent
+        staged_listings[schedule.name, key] = (time.monotonic(), limit, listing)
+        submissions = listing[0]
+        for poster in schedule.posters:
+            if listing_key(poster) != key:
+                continue
+            sent_submissions = context.bot_data["sent_submissions"][poster.chat]
+            for submission in submissions[: poster.limit]:
+                if submission["id"] not in sent_submissions and preparer.prefetch(
+                    submission["id"], partial(parse_reddit, submission, context)
+                ):
+                    prefetched.add(submission["id"])
+    logging.info(f"Prefetched {len(prefetched)} submissions for {schedule.name}")
+
+
+def schedule_run(job_queue: JobQueue, schedule: PosterSchedule, when: float):
+    job_queue.run_once(reddit_on_channel, when, data=schedule, name=schedule.name)
+    if PREFETCH_LEAD_MINUTES and when > PREFETCH_LEAD_MINUTES * 60:
+        job_queue.run_once(
+            prefetch_channel,
+            when - PREFETCH_LEAD_MINUTES * 60,
+            data=schedule,
+            name=f"prefetch {schedule.name}",
+        )
+
+
+def cursor_name(schedule_name: str, key: tuple[str, str]) -> str:
+    # schedules reading the same listing at different times each need their
+    # own cursor, or one of them would skip what the other one already saw
+    subreddits, sort_by = key
+    return f"{schedule_name}/{subreddits}/{sort_by}"
+
+
+async def fetch_listing(
+    context: RedditContext,
+    key: tuple[str, str],
+    limit: int,
+    schedule_name: str | None = None,
+) -> tuple[list[dict], dict | None]:
+    """The listing's submissions and the schedule's moved cursor, for
+    `store_cursor`; without a schedule the whole listing is fetched"""
+    subreddits, sort_by = key
+    with listing_fetch_seconds.time(subreddits=subreddits, sort=sort_by):
+        if not INCREMENTAL_LISTINGS or schedule_name is None:
+            submissions = await context.get_subreddit_submissions_raw(
+                subreddits, limit, sort_by
+            )
+            return submissions, None
+        cursors = context.bot_data.setdefault("listing_cursors", {})
+        cursor = cursors.get(cursor_name(schedule_name, key), {})
+        return await context.get_listing(subreddits, limit, sort_by, cursor)
+
+
+def store_cursor(
+    context: RedditContext,
+    schedule_name: str | None,
+    key: tuple[str, str],
+    cursor: dict | None,
 ):
+    """Keeps the cursor of a listing whose submissions have all been sent, a
+    run that fails or is interrupted fetches them again the next time"""
+    if schedule_name is not None and cursor is not None:
+        cursors = context.bot_data.setdefault("listing_cursors", {})
+        cursors[cursor_name(schedule_name, key)] = cursor
+
+
+async def run_channel_cycle(
+    context: RedditContext,
+    posters: list[type[Poster]],
+    schedule_name: str | None = None,
+) -> int:
+    """Sends the new submissions of the posters, returns how many there were
+
+    The listings are fetched incrementally with the cursors of the schedule
+    named `schedule_name`, if there's one.
+    """
+    stats = CycleStats()
+    poster_slots = asyncio.Semaphore(CHANNEL_CONCURRENCY)
+    listing_slots = asyncio.Semaphore(LISTING_CONCURRENCY)
+
+    async def fetch(key: tuple[str, str], limit: int):
+        staged = staged_listings.pop((schedule_name, key), None)
+        # a listing fetched by the prefetch job is used as long as it's recent
+        if staged and staged[1] >= limit and time.monotonic() - staged[0] < 3600:
+            return staged[2]
+        async with listing_slots:
+            with stats.measure("fetch"):
+                return await fetch_listing(context, key, limit, schedule_name)
+
+    listings = {
+        key: asyncio.create_task(fetch(key, limit))
+        for key, limit in plan_listings(posters).items()
+    }
+    # every submission is prepared once, whichever posters it goes to
+    acquired: dict[str, asyncio.Future[RedditSubmission | None]] = {}
+    new_submissions: dict[type[Poster], int] = {}
+
+    async def run_poster(poster: type[Poster]):
+        async with poster_slots:
+            submissions, _ = await listings[listing_key(poster)]
+            submissions = submissions[: poster.limit]
+            sent_submissions = context.bot_data["sent_submissions"][poster.chat]
+            submissions = [s for s in submissions if not sent_submissions.seen(s["id"])]
+            new_submissions[poster] = len(submissions)
+            for submission in submissions:
+                if submission["id"] not in acquired:
+                    # prepared ahead while earlier submissions are still being sent
+                    acquired[submission["id"]] = preparer.acquire(
+                        submission["id"], partial(parse_reddit, submission, context)
+                    )
+
+            async with chat_locks[poster.chat]:
+                for submission in submissions:
+                    if submission["id"] in sent_submissions:
+                        # another poster of the same chat got to it first
+                        continue
+                    with stats.measure("prepare"):
+                        parsed = await acquired[submission["id"]]
+                    submission_poster = await make_poster(
+                        parsed, submission, context, poster
+                    )
+                    if submission_poster is not None:
+                        with stats.measure("send"):
+                            await dispatch_reddit(
+                                poster.chat, submission, context, submission_poster
+                            )
+                    sent_submissions.add(submission["id"])
+
     try:
-        submission_poster = poster(await context.parse_submission(submission))
+        results = await asyncio.gather(
+            *(run_poster(poster) for poster in posters), return_exceptions=True
+        )
+    finally:
+        for task in listings.values():
+            task.cancel()
+        for submission_id in acquired:
+            preparer.release(submission_id)
+    failed = set()
+    for poster, result in zip(posters, results):
+        if isinstance(result, Exception):
+            failed.add(listing_key(poster))
+            logging.error(
+                f"{poster.__name__} failed: "
+                + "".join(traceback.format_exception(result))
+            )
+    for key, listing in listings.items():
+        if key not in failed:
+            store_cursor(context, schedule_name, key, listing.result()[1])
+    with stats.measure("persist"):
+        # commit the cycle's sent ids in one batch
+        await context.application.update_persistence()
+    logging.info(
+        f"Channel cycle finished ({len(listings)} listings for "
+        f"{len(posters)} posters): {stats.summary()}, "
+        f"{len(preparer)} prepared submissions waiting, "
+        f"reddit rate limit: {governor.status()}"
+    )
+    return sum(new_submissions.values())
+
+
+async def report_error(context: RedditContext, e: Exception, submission: dict):
+    await context.bot.send_message(
+        chat_id=OWNER_USER_ID, text=f"{repr(e)} in post {submission['id']}"
+    )
+    logging.error(traceback.format_exc())
+
+
+async def parse_reddit(
+    submission: dict, context: RedditContext
+) -> RedditSubmission | None:
+    start = time.perf_counter()
+    try:
+        parsed = await context.parse_submission(submission)
+    except Exception as e:
+        submissions_failed.inc(stage="parse")
+        await report_error(context, e, submission)
+        return None
+    prepare_seconds.observe(time.perf_counter() - start, media=media_type(parsed))
+    return parsed
+
+
+async def make_poster(
+    parsed: RedditSubmission | None,
+    submission: dict,
+    context: RedditContext,
+    poster: type[Poster],
+) -> Poster | None:
+    if parsed is None:
+        return None
+    try:
+        nsfw = None
+        if poster.nsfw is None:
+            nsfw = await context.all_subreddits_nsfw(poster.subreddits)
+        # the parsed submission is shared between posters and sending may modify it
+        submission_poster = poster(copy(parsed), nsfw)
         if submission_poster.should_post():
+            return submission_poster
+    except Exception as e:
+        await report_error(context, e, submission)
+    return None
+
+
+async def dispatch_reddit(
+    chat_id: str | int,
+    submission: dict,
+    context: RedditContext,
+    submission_poster: Poster,
+):
+    labels = {
+        "poster": type(submission_poster).__name__,
+        "chat": chat_id,
+        "media": media_type(submission_poster.submission),
+    }
+    try:
+        with send_seconds.time(**labels):
             await context.send_reddit_post(chat_id, submission_poster)
     except Exception as e:
-        await context.bot.send_message(
-            chat_id=OWNER_USER_ID, text=f"{repr(e)} in post {submission['id']}"
-        )
-        logging.error(traceback.format_exc())
+        submissions_failed.inc(stage="send", **labels)
+        await report_error(context, e, submission)
+    else:
+        submissions_sent.inc(**labels)
+
+
+async def send_reddit(
+    chat_id: str | int, submission: dict, context: RedditContext, poster: type[Poster]
+):
+    parsed = await parse_reddit(submission, context)
+    try:
+        submission_poster = await make_poster(parsed, submission, context, poster)
+        if submission_poster is not None:
+            await dispatch_reddit(chat_id, submission, context, submission_poster)
+    finally:
+        if parsed is not None:
+            parsed.cleanup()
 
 
 async def manual_reddit_on_channel(update: Update, context: RedditContext):
-    await reddit_on_channel(context)
+    await run_channel_cycle(context, channel_posters)
+
+
+async def stats(update: Update, context: RedditContext):
+    await update.effective_message.reply_text(registry.summary())
 
 
 async def unpinner(update: Update, context: RedditContext):
@@ -121,24 +407,57 @@ async def unpinner(update: Update, context: RedditContext):
 
 
 async def post_init(application: Application):
-    application.bot_data.setdefault("sent_submissions", defaultdict(list))
+    await open_client()
+    await metrics_server.start()
+    max_count = SENT_SUBMISSIONS_MAX_COUNT
+    max_age = SENT_SUBMISSIONS_MAX_AGE_DAYS * 24 * 3600
+    sent_submissions = application.bot_data.get("sent_submissions", {})
+    if not isinstance(sent_submissions, SentSubmissions):
+        # older versions stored a plain list of ids per chat
+        sent_submissions = SentSubmissions.migrate(
+            sent_submissions, max_count=max_count, max_age=max_age
+        )
+        application.bot_data["sent_submissions"] = sent_submissions
+    sent_submissions.configure(max_count, max_age)
+    subreddit_info = application.bot_data.setdefault(
+        "subreddit_info", SubredditInfoCache()
+    )
+    subreddit_info.ttl = SUBREDDIT_INFO_TTL_HOURS * 3600
+    # the cursors of schedules that don't exist anymore would only pile up
+    cursor_names = {
+        cursor_name(schedule.name, key)
+        for schedule in plan_schedules(channel_posters)
+        for key in plan_listings(schedule.posters)
+    }
+    cursors = application.bot_data.get("listing_cursors", {})
+    application.bot_data["listing_cursors"] = {
+        name: cursor for name, cursor in cursors.items() if name in cursor_names
+    }
     application.bot_data["group_chats"] = [
         (await application.bot.get_chat(poster.chat)).linked_chat_id
         for poster in channel_posters
     ]
 
 
+async def post_shutdown(application: Application):
+    await metrics_server.stop()
+    await close_client()
+
+
 def main():
     application = (
         Application.builder()
         .token(TOKEN)
         .defaults(Defaults(link_preview_options=LinkPreviewOptions(True)))
-        .persistence(PicklePersistence("persistence.pickle"))
+        .persistence(
+            SQLitePersistence("persistence.sqlite3", import_pickle="persistence.pickle")
+        )
         .write_timeout(300)
         .read_timeout(30)
         .context_types(ContextTypes(RedditContext))
         .rate_limiter(RateLimiter())
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -157,15 +476,37 @@ def main():
             filters.User(OWNER_USER_ID),
         )
     )
+    application.add_handler(CommandHandler("stats", stats, filters.User(OWNER_USER_ID)))
     application.add_handler(MessageHandler(filters.IS_AUTOMATIC_FORWARD, unpinner))
 
-    minutes_interval = 30
-
-    job.run_repeating(
-        reddit_on_channel,
-        interval=minutes_interval * 60,
-        first=datetime_round(datetime.now(pytz.UTC), minutes_interval),
-    )
+    schedules = plan_schedules(channel_posters)
+    now = datetime.now(pytz.UTC)
+    for i, schedule in enumerate(schedules):
+        # spread the first runs over the interval so they don't all start at once
+        first = datetime_round(now, schedule.interval) + timedelta(
+            minutes=schedule.interval * i / len(schedules)
+        )
+        if schedule.adaptive:
+            schedule_run(job, schedule, (first - now).total_seconds())
+        else:
+            job.run_repeating(
+                reddit_on_channel,
+                interval=schedule.interval * 60,
+                first=first,
+                data=schedule,
+                name=schedule.name,
+            )
+            if PREFETCH_LEAD_MINUTES:
+                prefetch_first = first - timedelta(minutes=PREFETCH_LEAD_MINUTES)
+                if prefetch_first < now:
+                    prefetch_first += timedelta(minutes=schedule.interval)
+                job.run_repeating(
+                    prefetch_channel,
+                    interval=schedule.interval * 60,
+                    first=prefetch_first,
+                    data=schedule,
+                    name=f"prefetch {schedule.name}",
+                )
 
     application.run_polling()
 
@@ -1,7 +1,7 @@
 from reddit_types import RedditSubmission
 from html import escape
 from telegram.constants import MessageLimit
-import textwrap
+from telegram_html import truncate_html, visible_length
 
 
 class Poster:
@@ -9,48 +9,53 @@ class Poster:
     chat: str | int | None = None
     limit: int = 10
     sort_by: str = "hot"
+    # minutes between two runs, adaptive posters move it between min_interval
+    # and max_interval depending on how many new submissions they find
+    interval: float = 30
+    adaptive: bool = False
+    min_interval: float = 5
+    max_interval: float = 120
+    # whether the subreddits are all NSFW, so there's no need to flag the posts,
+    # None looks it up from the subreddits' info
+    nsfw: bool | None = False
 
-    def __init__(self, submission: RedditSubmission) -> None:
+    def __init__(self, submission: RedditSubmission, nsfw: bool | None = None) -> None:
         self.submission = submission
+        if nsfw is not None:
+            self.nsfw = nsfw
 
     def should_post(self):
         return True
 
     def should_hide(self):
-        return self.submission.spoiler or self.submission.nsfw
+        return self.submission.spoiler or (self.submission.nsfw and not self.nsfw)
 
     def get_text(self, short=False):
         submission = self.submission
-        text = "🔞NSFW🔞\n" if submission.nsfw else ""
+        text = "🔞NSFW🔞\n" if submission.nsfw and not self.nsfw else ""
+        link = f'\n\n<a href="{escape(submission.post_url_long)}">{escape(submission.post_url)}</a>'
         if submission.text:
-            text += f"<b>{escape(submission.title)}</b>"
-            selftext = (
-                textwrap.shorten(
-                    submission.text,
-                    MessageLimit.CAPTION_LENGTH - 128,
-                    replace_whitespace=False,
+            text += f"<b>{escape(submission.title)}</b>\n\n"
+            selftext = submission.text
+            if short:
+                # the selftext gets whatever the rest of the caption leaves
+                selftext = truncate_html(
+                    selftext,
+                    MessageLimit.CAPTION_LENGTH - visible_length(text + link),
                 )
-                if short
-                else submission.text
-            )
 
             if self.should_hide():
-                text += f"\n\n<tg-spoiler>{selftext}</tg-spoiler>"
+                text += f"<tg-spoiler>{selftext}</tg-spoiler>"
             else:
-                text += f"\n\n{selftext}"
+                text += selftext
         else:
             text += escape(submission.title)
 
-        text += f'\n\n<a href="{escape(submission.post_url_long)}">{escape(submission.post_url)}</a>'
-        return text
+        return text + link
 
 
 class NSFWPoster(Poster):
-    def should_hide(self):
-        return self.submission.spoiler
-
-    def get_text(self, short=False):
-        return super().get_text(short).removeprefix("🔞NSFW🔞\n")
+    nsfw = True
 
 
 def get_channel_posters() -> list[type[Poster]]:
@@ -0,0 +1,258 @@
+"""Runs channel cycles against the offline reddit and Bot API stand-ins
+
+Run from the repository root: python -m benchmarks.bench_cycle [options]
+Reports the cycle throughput, the latency of every stage and the peak
+memory. --save writes the results to a file that a later run can be held
+against with --compare, which fails when throughput or memory regress.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+os.environ.setdefault("TOKEN", "1:bench")
+os.environ.setdefault("OWNER_USER_ID", "1")
+# the replay only knows www.reddit.com
+os.environ["REDDIT_CLIENT_ID"] = ""
+os.environ["MEDIA_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-media-")
+
+from telegram.ext import ApplicationBuilder, ContextTypes
+import custom_context
+import http_client
+from base_posters import Poster
+from custom_context import RedditContext
+from cycle_stats import CycleStats
+from muxer import ffmpeg_installed
+from ratelimiter import RateLimiter
+from stores import FileIdCache, SentSubmissions
+from benchmarks.replay import (
+    POST_KINDS,
+    FakeBotAPI,
+    FixtureServer,
+    FixtureStore,
+    ReplayTransport,
+    synthetic_store,
+)
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location(
+        "bot", Path(__file__).parent.parent / "__main__.py"
+    )
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+class RecordedStats(CycleStats):
+    """Keeps the stats of every cycle around for the report"""
+
+    cycles: list[CycleStats] = []
+
+    def __init__(self):
+        super().__init__()
+        RecordedStats.cycles.append(self)
+
+
+def make_posters(subreddits: list[str], chats: int, limit: int) -> list[type[Poster]]:
+    posters = []
+    for n in range(chats):
+        attributes = {
+            "subreddits": subreddits[n % len(subreddits)],
+            "chat": -1000000000000 - n,
+            "limit": limit,
+            # some look up whether their subreddits are nsfw
+            "nsfw": None if n % 3 == 2 else False,
+        }
+        posters.append(type(f"Bench{n}", (Poster,), attributes))
+    return posters
+
+
+def reset(context: RedditContext, caches: bool):
+    """Forgets what was sent, so that every cycle sends everything again, and
+    unless the caches are kept warm, everything that was cached"""
+    context.bot_data["sent_submissions"] = SentSubmissions()
+    context.bot_data["listing_cursors"] = {}
+    if caches:
+        context.bot_data["file_ids"] = FileIdCache()
+        custom_context.packaged_media.clear()
+        custom_context.media_sizes.clear()
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def report(results: dict):
+    print(
+        f"{results['cycles']} cycles, {results['submissions']} submissions, "
+        f"{results['throughput']:.1f} submissions/s"
+    )
+    print(f"  cycle: mean {results['cycle_mean'] * 1000:.0f} ms")
+    for stage, latency in results["stages"].items():
+        print(
+            f"  {stage:<8} n={latency['n']:<6} p50 {latency['p50'] * 1000:8.1f} ms"
+            f"  p95 {latency['p95'] * 1000:8.1f} ms  max {latency['max'] * 1000:8.1f} ms"
+        )
+    print(f"  telegram calls: {results['telegram_calls']}")
+    print(f"  reddit requests: {results['reddit_requests']}")
+    print(f"  uploaded: {results['uploaded'] / 1024:.0f} KiB")
+    print(f"  peak rss: {results['peak_rss'] / 1024:.0f} MiB", end="")
+    if results.get("peak_traced"):
+        print(f", peak traced: {results['peak_traced'] / 1024 / 1024:.1f} MiB", end="")
+    print()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if results["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {results['throughput']:.1f}/s, was {baseline['throughput']:.1f}/s"
+        )
+    for key in ("peak_rss", "peak_traced"):
+        if baseline.get(key) and results.get(key, 0) > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {results[key]}, was {baseline[key]}")
+    return regressions
+
+
+async def run(args) -> dict:
+    bot = load_bot()
+    bot.CycleStats = RecordedStats
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    subreddits = [f"bench{n}" for n in range(args.subreddits)]
+    kinds = dict(POST_KINDS)
+    server = None
+    if args.dash:
+        if not ffmpeg_installed():
+            sys.exit("--dash needs ffmpeg")
+        kinds["dash"] = 1
+        server = FixtureServer(FixtureStore()).__enter__()
+    if args.fixtures:
+        store = FixtureStore.load(Path(args.fixtures))
+        subreddits = args.fixture_subreddits or sys.exit("--fixtures needs --subreddit")
+    else:
+        store = synthetic_store(subreddits, args.posts, kinds, server)
+
+    transport = ReplayTransport(store, args.reddit_latency, args.reddit_jitter)
+    await http_client.open_client(transport)
+    api = FakeBotAPI(args.telegram_latency, args.upload_bandwidth, args.url_failures)
+    builder = (
+        ApplicationBuilder()
+        .token(os.environ["TOKEN"])
+        .request(api)
+        .get_updates_request(FakeBotAPI())
+        .context_types(ContextTypes(RedditContext))
+    )
+    if args.telegram_limits:
+        builder = builder.rate_limiter(RateLimiter())
+    application = builder.build()
+    await application.initialize()
+    context = RedditContext(application)
+    posters = make_posters(subreddits, args.chats, args.posts)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    durations = []
+    submissions = 0
+    try:
+        for _ in range(args.cycles):
+            reset(context, caches=not args.warm)
+            start = perf_counter()
+            submissions += await bot.run_channel_cycle(context, posters, "bench")
+            durations.append(perf_counter() - start)
+    finally:
+        peak_traced = tracemalloc.get_traced_memory()[1] if args.tracemalloc else 0
+        tracemalloc.stop()
+        await application.shutdown()
+        await http_client.close_client()
+        if server:
+            server.__exit__()
+
+    stages: dict[str, list[float]] = {}
+    for stats in RecordedStats.cycles:
+        for stage, values in stats.durations.items():
+            stages.setdefault(stage, []).extend(values)
+    return {
+        "cycles": args.cycles,
+        "submissions": submissions,
+        "throughput": submissions / sum(durations),
+        "cycle_mean": statistics.mean(durations),
+        "stages": {
+            stage: {
+                "n": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": max(values),
+            }
+            for stage, values in stages.items()
+        },
+        "telegram_calls": api.calls,
+        "reddit_requests": transport.requests,
+        "uploaded": api.uploaded,
+        # kilobytes on linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_traced": peak_traced,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--subreddits", type=int, default=4)
+    parser.add_argument("--posts", type=int, default=25, help="per subreddit")
+    parser.add_argument("--chats", type=int, default=6, help="one poster per chat")
+    parser.add_argument("--reddit-latency", type=float, default=0.05)
+    parser.add_argument("--reddit-jitter", type=float, default=0.05)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--upload-bandwidth", type=float, default=10_000_000, help="bytes/s"
+    )
+    parser.add_argument(
+        "--url-failures", type=float, default=0.1, help="share of urls refused"
+    )
+    parser.add_argument(
+        "--telegram-limits", action="store_true", help="throttle like production"
+    )
+    parser.add_argument("--dash", action="store_true", help="mux DASH videos")
+    parser.add_argument("--warm", action="store_true", help="keep the caches")
+    parser.add_argument("--fixtures", help="a directory of recorded fixtures")
+    parser.add_argument(
+        "--subreddit",
+        dest="fixture_subreddits",
+        action="append",
+        help="a recorded subreddit to post from",
+    )
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="fail if worse than these results")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=1))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit("Regressed: " + "; ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Times sanitizing and splitting large selftexts
+
+Run from the repository root: python -m benchmarks.bench_html
+"""
+
+import random
+import re
+import textwrap
+import timeit
+from functools import partial
+from collections import defaultdict
+from telegram.constants import MessageLimit
+from telegram_html import sanitize, split_html
+
+LEGACY_TAGS = ["b", "strong", "i", "em", "u", "ins", "s", "strike", "del"]
+LEGACY_TAGS += ["span", "a", "code", "pre", "blockquote"]
+
+
+def legacy_parse_selftext(selftext_html: str):
+    for match in re.findall(r"<(.*?)>", selftext_html):
+        if not any(match.split(" ")[0] in (tag, "/" + tag) for tag in LEGACY_TAGS):
+            selftext_html = selftext_html.replace(f"<{match}>", "")
+    return selftext_html.replace(
+        '<span class="md-spoiler-text">', '<span class="tg-spoiler">'
+    )
+
+
+def legacy_split(text: str):
+    texts = textwrap.wrap(
+        text,
+        MessageLimit.MAX_TEXT_LENGTH,
+        fix_sentence_endings=False,
+        replace_whitespace=False,
+    )
+    prefix = ""
+    for i, text in enumerate(texts):
+        text = prefix + text
+        counts: defaultdict[str, int] = defaultdict(int)
+        last: defaultdict[str, list[str]] = defaultdict(list)
+        for tag in re.findall(r"<(.*?)>", text):
+            name = tag.replace("/", "").split(" ")[0]
+            if tag[0] != "/":
+                last[name].append(tag)
+                counts[name] += 1
+            else:
+                counts[name] -= 1
+        prefix = ""
+        for name, count in counts.items():
+            if count > 0:
+                text += "</" + name * count + ">"
+                prefix += "<" + last[name].pop() + ">"
+        texts[i] = text
+    return texts
+
+
+def selftext(paragraphs: int, seed: int = 0) -> str:
+    """Something shaped like reddit's selftext_html"""
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "&amp;", "&lt;3", "😀"]
+    inline = [
+        "<strong>{}</strong>",
+        "<em>{}</em>",
+        '<a href="https://example.com/?a=1&amp;b=2">{}</a>',
+        '<span class="md-spoiler-text">{}</span>',
+        "<code>{}</code>",
+        "{}",
+        "{}",
+        "{}",
+    ]
+    body = []
+    for _ in range(paragraphs):
+        sentence = " ".join(
+            rng.choice(inline).format(" ".join(rng.choices(words, k=rng.randint(1, 6))))
+            for _ in range(rng.randint(5, 40))
+        )
+        body.append(rng.choice(["<p>{}</p>", "<ul><li>{}</li></ul>"]).format(sentence))
+    return (
+        '<!-- SC_OFF --><div class="md">' + "\n\n".join(body) + "</div><!-- SC_ON -->"
+    )
+
+
+def bench(name: str, function, argument, number: int):
+    seconds = min(timeit.repeat(lambda: function(argument), number=number, repeat=3))
+    print(f"  {name:<24} {seconds / number * 1000:9.2f} ms")
+
+
+def main():
+    limit = MessageLimit.MAX_TEXT_LENGTH
+    for paragraphs in (10, 100, 1000):
+        html = selftext(paragraphs)
+        number = max(1, 200 // paragraphs)
+        print(f"{paragraphs} paragraphs, {len(html)} characters")
+        bench("legacy parse_selftext", legacy_parse_selftext, html, number)
+        bench("sanitize", sanitize, html, number)
+        sanitized = sanitize(html)
+        bench("legacy split", legacy_split, sanitized, number)
+        bench("split_html", partial(split_html, limit=limit), sanitized, number)
+        legacy = len(legacy_split(legacy_parse_selftext(html)))
+        print(
+            f"  messages: legacy {legacy}, split_html {len(split_html(sanitized, limit))}"
+        )
+
+
+if __name__ == "__main__":
+    main()
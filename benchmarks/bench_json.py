@@ -0,0 +1,103 @@
+"""Times decoding reddit listings with every installed JSON decoder
+
+Run from the repository root: python -m benchmarks.bench_json [listing.json ...]
+Recorded listings (the raw body of /r/<subreddit>/<sort>?raw_json=1) can be
+passed as arguments; without them, synthetic 100 post listings are used.
+"""
+
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+from benchmarks.bench_memory import listing_entry
+from reddit_json import JSONDecoder, available_decoders
+
+
+def synthetic_listing(seed: int) -> bytes:
+    rng = random.Random(seed)
+    children = []
+    for i in range(100):
+        entry = listing_entry(rng, seed * 100 + i)
+        if i % 4 == 1:
+            # a gallery
+            ids = [f"{entry['id']}g{n}" for n in range(rng.randint(2, 20))]
+            entry["is_gallery"] = True
+            entry["gallery_data"] = {
+                "items": [{"media_id": id, "id": n} for n, id in enumerate(ids)]
+            }
+            entry["media_metadata"] = {
+                id: {
+                    "status": "valid",
+                    "e": "Image",
+                    "m": "image/jpg",
+                    "p": [
+                        {"y": w, "x": w, "u": f"https://preview.redd.it/{id}?w={w}"}
+                        for w in (108, 216, 320, 640, 960, 1080)
+                    ],
+                    "s": {"y": 2000, "x": 2000, "u": f"https://i.redd.it/{id}"},
+                    "id": id,
+                }
+                for id in ids
+            }
+        elif i % 4 == 2:
+            # a crosspost, which carries the whole parent along
+            entry["crosspost_parent_list"] = [listing_entry(rng, 10**6 + i)]
+        elif i % 4 == 3:
+            entry["is_video"] = True
+            entry["media"] = {
+                "reddit_video": {
+                    "fallback_url": "https://v.redd.it/x/DASH_720.mp4",
+                    "dash_url": "https://v.redd.it/x/DASHPlaylist.mpd",
+                    "hls_url": "https://v.redd.it/x/HLSPlaylist.m3u8",
+                    "width": 1280,
+                    "height": 720,
+                    "duration": 30,
+                    "bitrate_kbps": 2400,
+                    "transcoding_status": "completed",
+                }
+            }
+        children.append({"kind": "t3", "data": entry})
+    listing = {"kind": "Listing", "data": {"after": "t3_x", "before": None}}
+    listing["data"]["children"] = children
+    return json.dumps(listing).encode()
+
+
+def measure(decoder: JSONDecoder, content: bytes):
+    seconds = min(
+        timeit.repeat(lambda: decoder.decode_listing(content), number=5, repeat=3)
+    )
+    tracemalloc.start()
+    decoded = decoder.decode_listing(content)
+    snapshot = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    del decoded
+    return seconds / 5, blocks, peak
+
+
+def main():
+    if len(sys.argv) > 1:
+        fixtures = {Path(path).name: Path(path).read_bytes() for path in sys.argv[1:]}
+    else:
+        fixtures = {f"synthetic {seed}": synthetic_listing(seed) for seed in range(3)}
+
+    decoders = [JSONDecoder(name, typed=False) for name in available_decoders()]
+    if "msgspec" in available_decoders():
+        decoders.insert(0, JSONDecoder("msgspec", typed=True))
+
+    for name, content in fixtures.items():
+        print(f"{name}: {len(content) / 1024:.0f} KiB")
+        for decoder in decoders:
+            seconds, blocks, peak = measure(decoder, content)
+            label = decoder.name + (" (typed)" if decoder.typed else "")
+            print(
+                f"  {label:<16} {seconds * 1000:8.2f} ms"
+                f" {blocks:8} blocks kept {peak / 1024:8.0f} KiB peak"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Measures the memory held by a batch of 1000 listing entries and submissions
+
+Run from the repository root: python -m benchmarks.bench_memory
+"""
+
+import gc
+import json
+import random
+import tracemalloc
+from reddit_types import RedditImage, RedditSubmission, slim_submission
+from telegram_html import sanitize
+
+COUNT = 1000
+
+
+class LegacySubmission:
+    def __init__(self, title, id, permalink, score, flair, text, spoiler, nsfw):
+        self.title = title
+        self.id = id
+        self.score = score
+        self.flair = flair
+        self.text = text
+        self.post_url = "https://redd.it/" + id
+        self.post_url_long = "https://www.reddit.com" + permalink
+        self.spoiler = spoiler
+        self.nsfw = nsfw
+        self.data = None
+
+
+class LegacyImage:
+    media_id = None
+
+    def __init__(self, resolutions):
+        self.resolutions = resolutions
+
+
+def listing_entry(rng: random.Random, i: int) -> dict:
+    """An image post with roughly the keys and sizes of a real listing entry"""
+    id = f"{i:06x}"
+    image = f"https://preview.redd.it/{id}.jpg?width={{}}&amp;s=" + "0" * 40
+    entry = {
+        "id": id,
+        "name": f"t3_{id}",
+        "title": " ".join(rng.choices(["lorem", "ipsum", "dolor"], k=12)),
+        "permalink": f"/r/pics/comments/{id}/lorem_ipsum/",
+        "score": rng.randint(0, 50000),
+        "link_flair_text": None,
+        "selftext_html": None,
+        "spoiler": False,
+        "over_18": False,
+        "subreddit": "pics",
+        "removed_by_category": None,
+        "is_self": False,
+        "is_video": False,
+        "url": f"https://i.redd.it/{id}.jpg",
+        "url_overridden_by_dest": f"https://i.redd.it/{id}.jpg",
+        "preview": {
+            "images": [
+                {
+                    "source": {"url": image.format(4000), "width": 4000},
+                    "resolutions": [
+                        {"url": image.format(w), "width": w}
+                        for w in (108, 216, 320, 640, 960, 1080)
+                    ],
+                    "variants": {},
+                    "id": id,
+                }
+            ],
+            "enabled": True,
+        },
+        "all_awardings": [
+            {"id": f"award_{n}", "name": "Helpful", "description": "x" * 80}
+            for n in range(rng.randint(0, 5))
+        ],
+        "author_flair_richtext": [],
+        "link_flair_richtext": [],
+        "treatment_tags": [],
+        "mod_reports": [],
+        "user_reports": [],
+    }
+    # the dozens of scalar fields nothing here reads
+    for n in range(80):
+        entry[f"field_{n}"] = rng.choice([None, False, 0, "t2_" + "x" * 8])
+    return entry
+
+
+def measure(build) -> tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size, result
+
+
+def parse(entry: dict):
+    submission = RedditSubmission.from_listing(
+        entry, sanitize(entry["selftext_html"] or "")
+    )
+    resolutions = [
+        image["url"] for image in entry["preview"]["images"][0]["resolutions"]
+    ]
+    submission.data = RedditImage(resolutions[::-1])
+    return submission
+
+
+def parse_legacy(entry: dict):
+    submission = LegacySubmission(
+        entry["title"],
+        entry["id"],
+        entry["permalink"],
+        entry["score"],
+        entry["link_flair_text"],
+        sanitize(entry["selftext_html"] or ""),
+        entry["spoiler"],
+        entry["over_18"],
+    )
+    resolutions = [
+        image["url"] for image in entry["preview"]["images"][0]["resolutions"]
+    ]
+    submission.data = LegacyImage(resolutions[::-1])
+    return submission
+
+
+def main():
+    rng = random.Random(0)
+    response = json.dumps([listing_entry(rng, i) for i in range(COUNT)])
+
+    raw_size, raw = measure(lambda: json.loads(response))
+    del raw
+    # what stays alive once the decoded response has been dropped
+    slim_size, slim = measure(
+        lambda: [slim_submission(entry) for entry in json.loads(response)]
+    )
+    legacy_size, legacy = measure(lambda: [parse_legacy(entry) for entry in slim])
+    del legacy
+    parsed_size, parsed = measure(lambda: [parse(entry) for entry in slim])
+
+    print(f"{COUNT} listing entries")
+    print(f"  raw entries          {raw_size / 1024:9.0f} KiB")
+    print(f"  slim entries         {slim_size / 1024:9.0f} KiB")
+    print(f"  legacy submissions   {legacy_size / 1024:9.0f} KiB")
+    print(f"  slotted submissions  {parsed_size / 1024:9.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+"""Offline stand-ins for reddit and the Bot API
+
+`FixtureStore` holds recorded (or synthetic) responses by url.
+`ReplayTransport` serves them to httpx with a configurable latency, and
+`FixtureServer` serves the same fixtures over real HTTP on localhost for
+ffmpeg, which fetches the DASH renditions itself. `FakeBotAPI` answers the
+Bot API methods the bot uses, like Telegram would but without the network.
+
+Responses are recorded with `RecordingTransport`, or from the command line:
+python -m benchmarks.replay record <directory> <subreddit> [<subreddit> ...]
+"""
+
+import asyncio
+import base64
+import html
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from httpx import AsyncBaseTransport, AsyncHTTPTransport, Request, Response, URL
+from telegram.request import BaseRequest, RequestData
+
+
+@dataclass
+class Fixture:
+    body: bytes
+    status: int = 200
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+def fixture_key(url: URL | str) -> str:
+    """Fixtures are looked up by host and path, whether reddit was asked
+    through oauth.reddit.com or through www.reddit.com with .json urls"""
+    url = URL(url)
+    host = "www.reddit.com" if url.host == "oauth.reddit.com" else url.host
+    path = url.path.rstrip("/")
+    if host == "www.reddit.com":
+        path = path.removesuffix(".json")
+    return host + path
+
+
+class FixtureStore:
+    def __init__(self):
+        self.fixtures: dict[str, Fixture] = {}
+
+    def __len__(self):
+        return len(self.fixtures)
+
+    def add(self, url: str, body: bytes | str, status: int = 200, **headers: str):
+        body = body.encode() if isinstance(body, str) else body
+        self.fixtures[fixture_key(url)] = Fixture(body, status, headers)
+
+    def add_json(self, url: str, data):
+        self.add(url, json.dumps(data), content_type="application/json")
+
+    def lookup(self, url: URL | str) -> Fixture | None:
+        return self.fixtures.get(fixture_key(url))
+
+    def save(self, directory: Path):
+        """Writes the bodies next to an index.json of urls, statuses and headers"""
+        directory.mkdir(parents=True, exist_ok=True)
+        index = []
+        for n, (key, fixture) in enumerate(self.fixtures.items()):
+            (directory / f"{n}.bin").write_bytes(fixture.body)
+            index.append(
+                {
+                    "key": key,
+                    "file": f"{n}.bin",
+                    "status": fixture.status,
+                    "headers": fixture.headers,
+                }
+            )
+        (directory / "index.json").write_text(json.dumps(index, indent=1))
+
+    @classmethod
+    def load(cls, directory: Path) -> "FixtureStore":
+        store = cls()
+        for entry in json.loads((directory / "index.json").read_text()):
+            store.fixtures[entry["key"]] = Fixture(
+                (directory / entry["file"]).read_bytes(),
+                entry["status"],
+                entry["headers"],
+            )
+        return store
+
+
+class ReplayTransport(AsyncBaseTransport):
+    """Answers from a FixtureStore after `latency` seconds, plus up to `jitter`
+
+    Urls without a fixture get a 404. `requests` counts the requests by host.
+    """
+
+    def __init__(self, store: FixtureStore, latency: float = 0, jitter: float = 0):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.requests: dict[str, int] = {}
+
+    async def handle_async_request(self, request: Request) -> Response:
+        self.requests[request.url.host] = self.requests.get(request.url.host, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        fixture = self.store.lookup(request.url)
+        if fixture is None:
+            return Response(404, request=request)
+        headers = {
+            name.replace("_", "-"): value for name, value in fixture.headers.items()
+        }
+        content = b"" if request.method == "HEAD" else fixture.body
+        headers["content-length"] = str(len(fixture.body))
+        return Response(
+            fixture.status, headers=headers, content=content, request=request
+        )
+
+
+class RecordingTransport(AsyncBaseTransport):
+    """Passes requests on to `transport` and keeps every response in `store`"""
+
+    def __init__(self, transport: AsyncBaseTransport, store: FixtureStore):
+        self.transport = transport
+        self.store = store
+
+    async def handle_async_request(self, request: Request) -> Response:
+        response = await self.transport.handle_async_request(request)
+        body = await response.aread()
+        if request.method == "GET":
+            headers = {}
+            if "content-type" in response.headers:
+                headers["content_type"] = response.headers["content-type"]
+            self.store.add(str(request.url), body, response.status_code, **headers)
+        return Response(
+            response.status_code,
+            headers=response.headers,
+            content=body,
+            request=request,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class FixtureServer:
+    """Serves a FixtureStore over HTTP on localhost, in a background thread
+
+    Fixtures added under `url(path)` are served at that path.
+    """
+
+    def __init__(self, store: FixtureStore):
+        self.store = store
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixture = store.lookup(f"http://127.0.0.1{self.path}")
+                if fixture is None:
+                    self.send_error(404)
+                    return
+                self.send_response(fixture.status)
+                self.send_header("Content-Length", str(len(fixture.body)))
+                self.end_headers()
+                self.wfile.write(fixture.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls locally
+
+    Every call waits `latency` seconds, uploads also wait for their size at
+    `upload_bandwidth` bytes per second. A `url_failure_rate` share of the
+    media sent by url is refused the way Telegram refuses urls it can't
+    fetch, so that the download fallback gets exercised. `calls` counts the
+    calls by method and `uploaded` the bytes uploaded.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        upload_bandwidth: float = 0,
+        url_failure_rate: float = 0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+        self.url_failure_rate = url_failure_rate
+        self.random = random.Random(seed)
+        self.calls: dict[str, int] = {}
+        self.uploaded = 0
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        parameters = request_data.parameters if request_data else {}
+        upload = 0
+        if request_data and request_data.contains_files:
+            upload = sum(len(part[1]) for part in request_data.multipart_data.values())
+            self.uploaded += upload
+        delay = self.latency
+        if self.upload_bandwidth:
+            delay += upload / self.upload_bandwidth
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            result = self.answer(endpoint, parameters)
+        except ValueError as e:
+            return (
+                400,
+                json.dumps(
+                    {"ok": False, "error_code": 400, "description": str(e)}
+                ).encode(),
+            )
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def refuse_url(self, media) -> bool:
+        return (
+            isinstance(media, str)
+            and media.startswith("http")
+            and self.random.random() < self.url_failure_rate
+        )
+
+    def message(self, parameters: dict, **content) -> dict:
+        chat_id = parameters.get("chat_id", 1)
+        if isinstance(chat_id, str) and not chat_id.lstrip("-").isdigit():
+            chat = {"id": -1000000000000 - len(chat_id), "type": "channel"}
+        else:
+            chat = {"id": int(chat_id), "type": "channel"}
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": chat,
+            **content,
+        }
+
+    def file(self, **extra) -> dict:
+        n = next(self.message_ids)
+        return {"file_id": f"file{n}", "file_unique_id": f"unique{n}", **extra}
+
+    def answer(self, endpoint: str, parameters: dict):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench"}
+        if endpoint == "getChat":
+            return {"id": -1001, "type": "channel", "title": "bench"}
+        if endpoint == "sendMessage":
+            return self.message(parameters, text=parameters.get("text", ""))
+        if endpoint in ("sendPhoto", "sendVideo", "sendAnimation"):
+            kind = endpoint[4:].lower()
+            if self.refuse_url(parameters.get(kind)):
+                raise ValueError("Bad Request: failed to get HTTP URL content")
+            if kind == "photo":
+                return self.message(parameters, photo=[self.file(width=1, height=1)])
+            return self.message(
+                parameters, **{kind: self.file(width=1, height=1, duration=1)}
+            )
+        if endpoint == "sendMediaGroup":
+            media = parameters.get("media", [])
+            return [
+                self.message(
+                    parameters,
+                    **(
+                        {"photo": [self.file(width=1, height=1)]}
+                        if item.get("type") == "photo"
+                        else {"video": self.file(width=1, height=1, duration=1)}
+                    ),
+                )
+                for item in media
+            ]
+        return True
+
+
+# synthetic fixtures, shaped like what reddit returns
+
+
+def image_preview(rng: random.Random, id: str) -> dict:
+    url = f"https://preview.redd.it/{id}.jpg?width={{}}&s=" + "0" * 40
+    return {
+        "images": [
+            {
+                "source": {"url": url.format(4000), "width": 4000, "height": 3000},
+                "resolutions": [
+                    {"url": url.format(w), "width": w, "height": w * 3 // 4}
+                    for w in (108, 216, 320, 640, 960, 1080)
+                ],
+                "variants": {},
+                "id": id,
+            }
+        ],
+        "enabled": True,
+    }
+
+
+def selftext_html(rng: random.Random, paragraphs: int) -> str:
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "&amp;", "😀"]
+    body = "\n".join(
+        "<p>"
+        + " ".join(
+            rng.choice(["<strong>{}</strong>", "<em>{}</em>", "{}", "{}"]).format(
+                " ".join(rng.choices(words, k=rng.randint(1, 8)))
+            )
+            for _ in range(rng.randint(5, 30))
+        )
+        + "</p>"
+        for _ in range(paragraphs)
+    )
+    return f'<!-- SC_OFF --><div class="md">{body}</div><!-- SC_ON -->'
+
+
+def synthetic_post(
+    store: FixtureStore,
+    rng: random.Random,
+    subreddit: str,
+    id: str,
+    kind: str,
+    server: FixtureServer | None,
+    video: bytes,
+    image: bytes,
+) -> dict:
+    permalink = f"/r/{subreddit}/comments/{id}/lorem_ipsum/"
+    post = {
+        "id": id,
+        "name": f"t3_{id}",
+        "title": " ".join(rng.choices(["lorem", "ipsum", "dolor"], k=10)),
+        "permalink": permalink,
+        "score": rng.randint(0, 50000),
+        "link_flair_text": None,
+        "selftext_html": None,
+        "spoiler": False,
+        "over_18": False,
+        "subreddit": subreddit,
+        "removed_by_category": None,
+        "is_self": False,
+        "is_video": False,
+        "url": f"https://i.redd.it/{id}.jpg",
+    }
+    if kind == "text":
+        post["is_self"] = True
+        post["url"] = f"https://www.reddit.com{permalink}"
+        post["selftext_html"] = selftext_html(rng, rng.choice([1, 3, 10, 60]))
+    elif kind == "image":
+        post["url_overridden_by_dest"] = post["url"]
+        post["preview"] = image_preview(rng, id)
+    elif kind == "gif":
+        post["url"] = f"https://i.redd.it/{id}.gif"
+        post["preview"] = image_preview(rng, id)
+        post["preview"]["reddit_video_preview"] = {
+            "fallback_url": f"https://v.redd.it/{id}/gif.mp4"
+        }
+        store.add(post["preview"]["reddit_video_preview"]["fallback_url"], video)
+    elif kind == "gallery":
+        ids = [f"{id}g{n}" for n in range(rng.randint(2, 14))]
+        post["is_gallery"] = True
+        post["url"] = f"https://www.reddit.com/gallery/{id}"
+        post["gallery_data"] = {
+            "items": [{"media_id": m, "id": n} for n, m in enumerate(ids)]
+        }
+        post["media_metadata"] = {
+            m: {
+                "status": "valid",
+                "e": "Image",
+                "m": "image/jpg",
+                "p": [{"u": f"https://preview.redd.it/{m}.jpg?width=640"}],
+                "s": {"u": f"https://i.redd.it/{m}.jpg", "x": 2000, "y": 2000},
+            }
+            for m in ids
+        }
+        for m in ids:
+            store.add(f"https://i.redd.it/{m}.jpg", image, content_type="image/png")
+            store.add(
+                f"https://preview.redd.it/{m}.jpg", image, content_type="image/png"
+            )
+    elif kind in ("video", "dash"):
+        post["is_video"] = True
+        post["url"] = f"https://v.redd.it/{id}"
+        post["preview"] = image_preview(rng, id)
+        base = server.url(f"/{id}/") if server and kind == "dash" else post["url"] + "/"
+        post["media"] = {
+            "reddit_video": {
+                "fallback_url": base + "DASH_480.mp4",
+                "dash_url": base + "DASHPlaylist.mpd",
+                "width": 854,
+                "height": 480,
+                "duration": 30,
+            }
+        }
+        if kind == "video":
+            packaged = {
+                "playbackMp4s": {
+                    "permutations": [
+                        {"source": {"url": f"{base}CMAF_{h}.mp4"}} for h in (480, 720)
+                    ]
+                }
+            }
+            for h in (480, 720):
+                store.add(f"{base}CMAF_{h}.mp4", video, content_type="video/mp4")
+            player = html.escape(json.dumps(packaged))
+            page = f'<shreddit-player packaged-media-json="{player}"></shreddit-player>'
+        else:
+            page = "<html>no player</html>"
+            store.add(
+                base + "DASHPlaylist.mpd",
+                dash_manifest(),
+                content_type="application/dash+xml",
+            )
+            for rendition in ("DASH_480.mp4", "DASH_720.mp4", "DASH_AUDIO_128.mp4"):
+                store.add(base + rendition, video)
+        store.add(
+            f"https://www.reddit.com{permalink}",
+            "<html>" + "<div>filler</div>" * 2000 + page + "</html>",
+        )
+    if "preview" in post:
+        store.add(f"https://preview.redd.it/{id}.jpg", image, content_type="image/png")
+    if post["url"].startswith("https://i.redd.it/"):
+        store.add(post["url"], image, content_type="image/png")
+    return post
+
+
+def dash_manifest() -> str:
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" mediaPresentationDuration="PT30S">
+ <Period>
+  <AdaptationSet contentType="video">
+   <Representation bandwidth="2400000"><BaseURL>DASH_720.mp4</BaseURL></Representation>
+   <Representation bandwidth="1200000"><BaseURL>DASH_480.mp4</BaseURL></Representation>
+  </AdaptationSet>
+  <AdaptationSet contentType="audio">
+   <Representation bandwidth="128000"><BaseURL>DASH_AUDIO_128.mp4</BaseURL></Representation>
+  </AdaptationSet>
+ </Period>
+</MPD>"""
+
+
+POST_KINDS = {"text": 3, "image": 4, "gif": 1, "gallery": 1, "video": 1, "dash": 0}
+
+
+def synthetic_store(
+    subreddits: list[str],
+    posts: int = 25,
+    kinds: dict[str, int] = POST_KINDS,
+    server: FixtureServer | None = None,
+    video_size: int = 200_000,
+    seed: int = 0,
+) -> FixtureStore:
+    """Listings of `posts` submissions for each subreddit (sorted by hot and
+    by new), with the pages, manifests and media their posts point to"""
+    store = server.store if server else FixtureStore()
+    rng = random.Random(seed)
+    video = rng.randbytes(video_size)
+    # every image resolves to the same tiny png
+    image = base64.b64decode(
+        "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+    )
+    info = []
+    for i, subreddit in enumerate(subreddits):
+        children = []
+        for n in range(posts):
+            kind = rng.choices(list(kinds), weights=list(kinds.values()))[0]
+            id = f"{seed:02x}{i:02x}{n:04x}"
+            post = synthetic_post(store, rng, subreddit, id, kind, server, video, image)
+            children.append({"kind": "t3", "data": post})
+        listing = {"kind": "Listing", "data": {"children": children, "after": None}}
+        for sort_by in ("hot", "new"):
+            store.add_json(
+                f"https://www.reddit.com/r/{subreddit}/{sort_by}.json", listing
+            )
+        info.append(
+            {
+                "kind": "t5",
+                "data": {"display_name": subreddit, "over18": False, "subscribers": 1},
+            }
+        )
+    store.add_json("https://www.reddit.com/api/info.json", {"data": {"children": info}})
+    return store
+
+
+async def record(directory: Path, subreddits: list[str]):
+    """Fetches and parses the hot listings of `subreddits`, keeping every response"""
+    import http_client
+    from custom_context import RedditContext
+    from telegram.ext import ApplicationBuilder, ContextTypes
+
+    store = FixtureStore()
+    await http_client.open_client(RecordingTransport(AsyncHTTPTransport(), store))
+    application = (
+        ApplicationBuilder()
+        .token("1:record")
+        .request(FakeBotAPI())
+        .context_types(ContextTypes(RedditContext))
+        .build()
+    )
+    context = RedditContext(application)
+    for subreddit in subreddits:
+        for submission in await context.get_subreddit_submissions_raw(subreddit, 25):
+            try:
+                (await context.parse_submission(submission)).cleanup()
+            except Exception as e:
+                print(f"{submission['id']}: {e!r}")
+    await http_client.close_client()
+    store.save(directory)
+    print(f"Recorded {len(store)} responses in {directory}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "record":
+        sys.exit(__doc__)
+    asyncio.run(record(Path(sys.argv[2]), sys.argv[3:]))
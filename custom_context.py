@@ -1,18 +1,25 @@
 import asyncio
-from collections import defaultdict
-from typing import Any, Callable, Coroutine, cast
-from httpx import AsyncClient
+from typing import Any, Callable, Coroutine
+from httpx import URL, AsyncClient, HTTPError, Response
+from http_client import get_client
+from reddit_auth import token_manager
+from reddit_ratelimit import governor
+from muxer import ffmpeg_installed, mux
+from media_cache import media_cache
+from metrics import download_seconds, media_probe_seconds
+from stores import FileIdCache, SubredditInfoCache
+from dash import Rendition, parse_manifest, select_renditions
+from packaged_media import fetch_packaged_media
+from reddit_json import json_decoder
+from telegram_html import sanitize, split_html
 from telegram.ext import Application, CallbackContext, ExtBot
 from telegram.error import BadRequest
 from telegram.constants import MessageLimit
 from telegram import InputMediaPhoto, InputMediaVideo, Message
-from html import unescape as unescape_html
-import textwrap
 import re
-import json
-import subprocess
 import logging
-import os
+import time
+from pathlib import Path
 from posters import Poster
 from reddit_types import (
     RedditSubmission,
@@ -23,21 +30,17 @@ from reddit_types import (
     RedditImage,
 )
 
-ffmpeg_logger = logging.getLogger("ffmpeg")
 logger = logging.getLogger("bot")
 
-__import__("dotenv").load_dotenv()
+UPLOAD_LIMIT = 50_000_000
+PROBE_TIMEOUT = 10
+GALLERY_CONCURRENCY = 4
+CURSOR_MAX_AGE = 6 * 3600
+MEDIA_SIZES_CACHE_SIZE = 1024
+PACKAGED_MEDIA_CACHE_SIZE = 256
 
-REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
-REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
-
-
-def ffmpeg_installed():
-    try:
-        subprocess.run(["ffmpeg", "-v", "quiet"])
-        return True
-    except FileNotFoundError:
-        return False
+media_sizes: dict[str, int] = {}
+packaged_media: dict[str, dict | None] = {}
 
 
 def chunks(lst: list, n: int):
@@ -48,24 +51,6 @@ def chunks(lst: list, n: int):
 class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
     __base_headers = {"User-Agent": "kyryh/reddit2telegram"}
 
-    __telegram_html_tags = [
-        "b",
-        "strong",
-        "i",
-        "em",
-        "u",
-        "ins",
-        "s",
-        "strike",
-        "del",
-        "span",
-        "a",
-        "code",
-        "pre",
-        "code",
-        "blockquote",
-    ]
-
     def __init__(
         self,
         application: Application,
@@ -73,8 +58,14 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
         user_id: int | None = None,
     ):
         super().__init__(application, chat_id, user_id)
-        self.client = AsyncClient()
-        self.access_token: str | None = None
+
+    @property
+    def client(self) -> AsyncClient:
+        return get_client()
+
+    @property
+    def access_token(self) -> str | None:
+        return token_manager.access_token
 
     @property
     def headers(self):
@@ -85,27 +76,67 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
         )
 
     async def update_access_token(self):
-        if REDDIT_CLIENT_ID and REDDIT_CLIENT_SECRET:
-            req = await self.client.post(
-                "https://www.reddit.com/api/v1/access_token",
-                data={"grant_type": "client_credentials"},
-                auth=(REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET),
+        await token_manager.get_token(self.client)
+
+    async def governed_get(
+        self, url: str, params: dict | None = None, headers: dict | None = None
+    ) -> Response:
+        attempt = 0
+        while True:
+            await governor.wait()
+            req = await self.client.get(
+                url, params=params, headers=self.headers | (headers or {})
+            )
+            governor.update(req)
+            if not governor.should_retry(req, attempt):
+                return req
+            delay = governor.backoff(req, attempt)
+            attempt += 1
+            logger.warning(
+                f"Reddit answered {req.status_code}, retry {attempt} in {delay:.1f}s"
             )
-            self.access_token = req.json()["access_token"]
+            await asyncio.sleep(delay)
+
+    async def reddit_get(
+        self, path: str, params: dict | None = None, headers: dict | None = None
+    ) -> Response:
+        access_token = await token_manager.get_token(self.client)
+        if not access_token:
+            if not path.endswith(".json"):
+                path += ".json"
+            return await self.governed_get(
+                f"https://www.reddit.com{path}", params, headers
+            )
+        req = await self.governed_get(
+            f"https://oauth.reddit.com{path}", params, headers
+        )
+        if req.status_code == 401:
+            await token_manager.invalidate(self.client, access_token)
+            req = await self.governed_get(
+                f"https://oauth.reddit.com{path}", params, headers
+            )
+        return req
+
+    @property
+    def subreddit_info(self) -> SubredditInfoCache:
+        return self.bot_data.setdefault("subreddit_info", SubredditInfoCache())
 
     async def get_subreddits_info(self, subreddits: str) -> list[dict]:
-        await self.update_access_token()
-        if self.access_token:
-            req = await self.client.get(
-                f"https://oauth.reddit.com/api/info.json?sr_name={subreddits.replace('+', ',')}",
-                headers=self.headers,
-            )
-        else:
-            req = await self.client.get(
-                f"https://www.reddit.com/api/info.json?sr_name={subreddits.replace('+', ',')}",
-                headers=self.headers,
+        names = [name for name in subreddits.split("+") if name]
+        found, missing = self.subreddit_info.lookup(names)
+        if missing:
+            req = await self.reddit_get(
+                "/api/info.json", {"sr_name": ",".join(missing)}
             )
-        return [subreddit["data"] for subreddit in req.json()["data"]["children"]]
+            req.raise_for_status()
+            for subreddit in json_decoder.decode(req.content)["data"]["children"]:
+                info = subreddit["data"]
+                self.subreddit_info.set(info["display_name"], info)
+                found[info["display_name"].lower()] = info
+            for name in missing:
+                if name not in found:
+                    self.subreddit_info.set(name, None)
+        return [info for info in found.values() if info is not None]
 
     async def all_subreddits_nsfw(self, subreddits: str):
         return all(
@@ -116,36 +147,72 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
     async def get_subreddit_submissions_raw(
         self, subreddit: str, limit: int, sort_by: str = "hot"
     ) -> list[dict]:
-        await self.update_access_token()
-        if self.access_token:
-            req = await self.client.get(
-                f"https://oauth.reddit.com/r/{subreddit}/{sort_by}?limit={limit}&raw_json=1",
-                headers=self.headers,
-            )
-        else:
-            req = await self.client.get(
-                f"https://www.reddit.com/r/{subreddit}/{sort_by}.json?limit={limit}&raw_json=1",
-                headers=self.headers,
-            )
-        req.raise_for_status()
-        data = req.json()
-        submissions = [submission["data"] for submission in data["data"]["children"]]
+        submissions, _ = await self.get_listing(subreddit, int(limit), sort_by)
         return submissions
 
+    async def get_listing(
+        self,
+        subreddit: str,
+        limit: int,
+        sort_by: str = "hot",
+        cursor: dict | None = None,
+    ) -> tuple[list[dict], dict | None]:
+        """Fetches up to `limit` submissions, 100 per page
+
+        With a `cursor` (a dict kept between calls) the fetch is incremental:
+        for the "new" sort only the submissions newer than the last newest
+        one are requested, and the first page is a conditional request that
+        returns nothing when reddit answers 304 Not Modified.
+        The cursor itself isn't touched, the moved one is returned with the
+        submissions so that it's only kept once they have been handled.
+        """
+        if cursor is not None:
+            cursor = dict(cursor)
+        incremental = cursor is not None and sort_by == "new"
+        if incremental and time.time() - cursor.get("updated", 0) > CURSOR_MAX_AGE:
+            # `before` returns nothing once its submission is deleted, so a cursor
+            # that hasn't moved in a while is retried with a full fetch
+            cursor.pop("before", None)
+        backwards = incremental and "before" in cursor
+        page_cursor = cursor.get("before") if backwards else None
+
+        submissions: list[dict] = []
+        while len(submissions) < limit:
+            params = {"limit": min(limit - len(submissions), 100), "raw_json": 1}
+            if page_cursor:
+                params["before" if backwards else "after"] = page_cursor
+            headers = {}
+            if cursor is not None and not submissions:
+                if cursor.get("etag"):
+                    headers["If-None-Match"] = cursor["etag"]
+                if cursor.get("last_modified"):
+                    headers["If-Modified-Since"] = cursor["last_modified"]
+            req = await self.reddit_get(f"/r/{subreddit}/{sort_by}", params, headers)
+            if req.status_code == 304:
+                break
+            req.raise_for_status()
+            if cursor is not None and not submissions:
+                cursor["etag"] = req.headers.get("ETag")
+                cursor["last_modified"] = req.headers.get("Last-Modified")
+            page, before, after = json_decoder.decode_listing(req.content)
+            # pages before the cursor come newest first, but the newer pages first
+            submissions = page + submissions if backwards else submissions + page
+            page_cursor = before if backwards else after
+            if not page or not page_cursor:
+                break
+
+        # going backwards the ones closest to the cursor come first, so that
+        # a backlog bigger than `limit` is caught up on over the next cycles
+        submissions = submissions[-limit:] if backwards else submissions[:limit]
+        if incremental and submissions:
+            cursor["before"] = submissions[0]["name"]
+            cursor["updated"] = time.time()
+        return submissions, cursor
+
     async def get_submission_raw(self, submission_id: str) -> dict:
-        await self.update_access_token()
-        if self.access_token:
-            req = await self.client.get(
-                f"https://oauth.reddit.com/comments/{submission_id}?raw_json=1",
-                headers=self.headers,
-            )
-        else:
-            req = await self.client.get(
-                f"https://www.reddit.com/comments/{submission_id}.json?raw_json=1",
-                headers=self.headers,
-            )
+        req = await self.reddit_get(f"/comments/{submission_id}", {"raw_json": 1})
         req.raise_for_status()
-        return req.json()[0]["data"]["children"][0]["data"]
+        return json_decoder.decode_submission(req.content)
 
     async def get_subreddit_submissions(
         self, subreddit: str, limit: int, sort_by: str = "hot"
@@ -158,21 +225,63 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
     async def get_submission(self, submission_id: str) -> RedditSubmission:
         return await self.parse_submission(await self.get_submission_raw(submission_id))
 
-    async def get_media_size(self, url: str):
-        return int((await self.client.head(url)).headers["Content-Length"])
+    async def get_media_size(self, url: str) -> int | None:
+        """The Content-Length of the url, None if it's unknown or the HEAD failed"""
+        if url in media_sizes:
+            return media_sizes[url]
+        response = await self.client.head(url)
+        if not response.is_success:
+            # the length of an error page says nothing about the media
+            return None
+        content_length = response.headers.get("Content-Length")
+        size = int(content_length) if content_length else None
+        if size is not None:
+            if len(media_sizes) >= MEDIA_SIZES_CACHE_SIZE:
+                del media_sizes[next(iter(media_sizes))]
+            media_sizes[url] = size
+        return size
+
+    async def probe_media_sizes(
+        self, urls: list[str], timeout: float = PROBE_TIMEOUT
+    ) -> dict[str, int | None]:
+        """HEADs all the urls at once, the ones that fail or time out map to None"""
+
+        async def probe(url: str):
+            try:
+                return await asyncio.wait_for(self.get_media_size(url), timeout)
+            except (HTTPError, asyncio.TimeoutError):
+                return None
+
+        with media_probe_seconds.time():
+            sizes = await asyncio.gather(*(probe(url) for url in urls))
+        return dict(zip(urls, sizes))
+
+    async def get_packaged_media(self, submission_id: str, permalink: str):
+        """The mp4 renditions listed in the post page, cached per submission"""
+        if submission_id in packaged_media:
+            return packaged_media[submission_id]
+        try:
+            media = await fetch_packaged_media(
+                self.client, f"https://www.reddit.com{permalink}", self.headers
+            )
+        except HTTPError:
+            # not cached, the dash manifest is used this time
+            return None
+        if len(packaged_media) >= PACKAGED_MEDIA_CACHE_SIZE:
+            del packaged_media[next(iter(packaged_media))]
+        packaged_media[submission_id] = media
+        return media
+
+    async def download(self, url: str, media: str) -> Path:
+        """The cached file, to be given back with media_cache.release once sent"""
+        with download_seconds.time(media=media):
+            return await media_cache.fetch(self.client, url)
 
     async def parse_submission(self, s: dict) -> RedditSubmission:
         if s.get("removed_by_category"):
             raise Exception("The post has been deleted")
-        submission = RedditSubmission(
-            s["title"],
-            s["id"],
-            s["permalink"],
-            s["score"],
-            s["link_flair_text"],
-            self.parse_selftext(s["selftext_html"] or ""),
-            s["spoiler"],
-            s["over_18"],
+        submission = RedditSubmission.from_listing(
+            s, self.parse_selftext(s["selftext_html"] or "")
         )
 
         og_s = s
@@ -180,25 +289,13 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
             s = s["crosspost_parent_list"][0]
 
         if s["is_video"]:
-            req = (
-                await self.client.get(
-                    f"https://www.reddit.com{s['permalink']}", headers=self.headers
-                )
-            ).text
-
             if s["preview"]["images"][0]["resolutions"]:
                 thumb = s["preview"]["images"][0]["resolutions"][-1]
             else:
                 thumb = s["preview"]["images"][0]["source"]
 
-            re_match = re.search(
-                r'<shreddit-player.*packaged-media-json="(.*?)".*<\/shreddit-player>',
-                req,
-                re.S,
-            )
-            if re_match:
-                video_urls = json.loads(unescape_html(re_match.group(1)))
-
+            video_urls = await self.get_packaged_media(s["id"], s["permalink"])
+            if video_urls:
                 submission.data = RedditVideo(
                     [
                         video["source"]["url"]
@@ -214,60 +311,27 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                 video_info = await self.client.get(
                     s["media"]["reddit_video"]["dash_url"], headers=self.headers
                 )
-                video_urls = []
-                audio_urls = []
-                for format in re.findall(r"<BaseURL>(.*?)<\/BaseURL>", video_info.text)[
-                    ::-1
-                ]:
-                    url = f"{s['url']}/{format}"
-                    if "AUDIO" in format:
-                        audio_urls.append(url)
-                    else:
-                        video_urls.append(url)
-                video_urls.insert(0, s["media"]["reddit_video"]["fallback_url"])
-
-                if audio_urls:
-                    video = audio = None
-                    for audio_url in audio_urls:
-                        if video is not None:
-                            break
-                        audio_size = await self.get_media_size(audio_url)
-                        for video_url in video_urls:
-                            if (
-                                await self.get_media_size(video_url) + audio_size
-                                < 50_000_000
-                            ):
-                                video = video_url
-                                audio = audio_url
-                                break
-
-                    result: subprocess.CompletedProcess = subprocess.run(
-                        [
-                            "ffmpeg",
-                            "-i",
-                            cast(str, video),
-                            "-i",
-                            cast(str, audio),
-                            "-y",
-                            "-v",
-                            "warning",
-                            "-c",
-                            "copy",
-                            "video.mp4",
-                        ],
-                        capture_output=True,
-                        text=True,
+                reddit_video = s["media"]["reddit_video"]
+                videos, audios, duration = parse_manifest(video_info.text, s["url"])
+                videos.insert(0, Rendition(reddit_video["fallback_url"]))
+                duration = duration or reddit_video.get("duration")
+
+                if audios:
+                    sizes = await self.probe_media_sizes(
+                        [rendition.url for rendition in videos + audios]
                     )
-                    output = f"{result.stdout}\n{result.stderr}"
-                    if not output.isspace():
-                        ffmpeg_logger.info(output)
-                    result.check_returncode()
-                    with open("video.mp4", "rb") as f:
-                        videos = [f.read()]
-                    os.remove("video.mp4")
+                    selected = select_renditions(
+                        videos, audios, sizes, duration, UPLOAD_LIMIT
+                    )
+                    if selected is None:
+                        raise Exception("No video and audio pair fits the upload limit")
+                    video, audio = selected
+                    # the file is handed to send_video as is, so the video is only
+                    # read while it's being uploaded; it's deleted by cleanup()
+                    videos = [await mux(video.url, audio.url)]
 
                 else:
-                    videos = video_urls
+                    videos = [rendition.url for rendition in videos]
 
                 submission.data = RedditVideo(
                     videos,
@@ -332,59 +396,72 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
         elif not s["is_self"]:
             submission.text += f"\n\n{s['url'].strip()}"
 
+        if submission.data:
+            submission.data.media_id = s["id"]
         submission.text = submission.text.strip()
 
         return submission
 
-    def parse_selftext(self, selftext_html: str):
-        matches: list[str] = re.findall(r"<(.*?)>", selftext_html)
-        for match in matches:
-            if not any(
-                match.split(" ")[0] in (tag, "/" + tag)
-                for tag in self.__telegram_html_tags
-            ):
-                selftext_html = selftext_html.replace(f"<{match}>", "")
-        selftext_html = selftext_html.replace(
-            '<span class="md-spoiler-text">', '<span class="tg-spoiler">'
-        )
-        return selftext_html
-
     @staticmethod
-    def fix_tags_single(text: str) -> tuple[str, str]:
-        tags: list[str] = re.findall(r"<(.*?)>", text)
-        tags_count = defaultdict(int)
-        last_tags = defaultdict(list)
-        for tag in tags:
-            effective_tag = tag.replace("/", "").split(" ")[0]
-            if tag[0] != "/":
-                last_tags[effective_tag].append(tag)
-                tags_count[effective_tag] += 1
-            else:
-                tags_count[effective_tag] -= 1
+    def parse_selftext(selftext_html: str):
+        return sanitize(selftext_html)
 
-        next_text_prefix = ""
-        for tag, count in tags_count.items():
-            if count > 0:
-                text += "</" + tag * count + ">"
-                next_text_prefix += "<" + last_tags[tag].pop() + ">"
-
-        return text, next_text_prefix
+    @property
+    def file_ids(self) -> FileIdCache:
+        return self.bot_data.setdefault("file_ids", FileIdCache())
 
     @staticmethod
-    def fix_tags_multiple(texts: list[str]) -> list[str]:
-        new_texts = list(texts)
-        text_prefix = ""
-        for i in range(len(new_texts)):
-            new_texts[i], text_prefix = RedditContext.fix_tags_single(
-                text_prefix + new_texts[i]
-            )
-        return new_texts
+    def get_file_id(message: Message) -> str | None:
+        attachment = message.effective_attachment
+        if isinstance(attachment, (tuple, list)):
+            # photos come in several sizes, the last one is the biggest
+            attachment = attachment[-1] if attachment else None
+        return getattr(attachment, "file_id", None)
 
     async def send_media(
         self,
         bot_method: Callable[..., Coroutine[Any, Any, Message]],
         chat_id: int | str,
-        media: list[str | bytes],
+        media: list[str | bytes | Path],
+        cache_key: str | None = None,
+        thumbnail: str | None = None,
+        **kwargs,
+    ):
+        file_id = self.file_ids.get(cache_key)
+        if file_id is not None:
+            try:
+                return await bot_method(
+                    chat_id,
+                    file_id,
+                    **kwargs,
+                    parse_mode="HTML",
+                    show_caption_above_media=True,
+                )
+            except BadRequest as e:
+                logger.warning(f"Cached file_id for {cache_key} rejected ({e.message})")
+                self.file_ids.invalidate(cache_key)
+
+        downloads: list[Path] = []
+        try:
+            # thumbnails are ignored when resending a file_id, so they're only
+            # downloaded once the media is really uploaded
+            if thumbnail:
+                kwargs["thumbnail"] = await self.download(thumbnail, "thumbnail")
+                downloads.append(kwargs["thumbnail"])
+            return await self.upload_media(
+                bot_method, chat_id, media, cache_key, downloads, **kwargs
+            )
+        finally:
+            for path in downloads:
+                media_cache.release(path)
+
+    async def upload_media(
+        self,
+        bot_method: Callable[..., Coroutine[Any, Any, Message]],
+        chat_id: int | str,
+        media: list[str | bytes | Path],
+        cache_key: str | None,
+        downloads: list[Path],
         **kwargs,
     ):
         index = 0
@@ -400,6 +477,8 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                     show_caption_above_media=True,
                     filename=filename,
                 )
+                if cache_key is not None and (file_id := self.get_file_id(message)):
+                    self.file_ids.set(cache_key, file_id)
                 return message
             except BadRequest as e:
                 if e.message not in [
@@ -411,25 +490,24 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                     raise e
                 if (
                     isinstance(current_media, str)
-                    and await self.get_media_size(current_media) < 50_000_000
+                    and (await self.get_media_size(current_media) or UPLOAD_LIMIT)
+                    < UPLOAD_LIMIT
                 ):
-                    current_media = await self.client.get(current_media)
-                    filename = current_media.url.path.split("/")[-1]
+                    filename = URL(current_media).path.split("/")[-1]
+                    current_media = await self.download(current_media, "upload")
+                    downloads.append(current_media)
                 else:
                     index += 1
-                    current_media = media[index]
+                    if index < len(media):
+                        current_media = media[index]
         return None
 
     async def send_reddit_post(self, chat_id: int, submission_poster: Poster):
         submission = submission_poster.submission
         if not submission.data:
-            texts = textwrap.wrap(
-                submission_poster.get_text(),
-                MessageLimit.MAX_TEXT_LENGTH,
-                fix_sentence_endings=False,
-                replace_whitespace=False,
+            texts = split_html(
+                submission_poster.get_text(), MessageLimit.MAX_TEXT_LENGTH
             )
-            texts = self.fix_tags_multiple(texts)
             for text in texts:
                 await self.bot.send_message(
                     chat_id=chat_id, text=text, parse_mode="HTML"
@@ -439,6 +517,7 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                 self.bot.send_photo,
                 chat_id,
                 submission.data.resolutions,
+                f"image:{submission.data.media_id}",
                 caption=submission_poster.get_text(short=True),
                 has_spoiler=submission_poster.should_hide(),
             )
@@ -455,15 +534,14 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                 self.bot.send_video,
                 chat_id,
                 submission.data.resolutions,
+                f"video:{submission.data.media_id}",
+                submission.data.thumbnail,
                 duration=submission.data.duration,
                 caption=submission_poster.get_text(short=True),
                 width=submission.data.width,
                 height=submission.data.height,
                 supports_streaming=True,
                 has_spoiler=submission_poster.should_hide(),
-                thumbnail=(await self.client.get(submission.data.thumbnail)).content
-                if submission.data.thumbnail
-                else None,
             )
             if not video_sent:
                 raise Exception("something happened idk what (video)")
@@ -473,13 +551,12 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
                 self.bot.send_animation,
                 chat_id,
                 submission.data.resolutions,
+                f"gif:{submission.data.media_id}",
+                submission.data.thumbnail,
                 caption=submission_poster.get_text(short=True),
                 has_spoiler=submission_poster.should_hide(),
                 width=submission.data.width,
                 height=submission.data.height,
-                thumbnail=(await self.client.get(submission.data.thumbnail)).content
-                if submission.data.thumbnail
-                else None,
             )
             if not gif_sent:
                 raise Exception("something happened idk what (gif)")
@@ -488,44 +565,77 @@ class RedditContext(CallbackContext[ExtBot, dict, dict, dict]):
             await self.bot.send_message(
                 chat_id=chat_id, text=submission_poster.get_text(), parse_mode="HTML"
             )
-            spoiler = submission_poster.should_hide()
-            gallery = []
-            gallery_lower = []
-            for item in submission.data.items:
-                match item.type:
-                    case "Image":
-                        InputMedia = InputMediaPhoto
-                        media = item.media
-                        media_lower = item.media_lower
-                    case "AnimatedImage":
-                        InputMedia = InputMediaVideo
-                        media = (await self.client.get(item.media)).content
-                        media_lower = (
-                            (await self.client.get(item.media_lower)).content
-                            if item.media_lower
-                            else None
-                        )
-                    case _:
-                        raise Exception(f"Unsupported gallery media type ({item.type})")
-
-                gallery.append(InputMedia(media, item.caption, has_spoiler=spoiler))
-                if media_lower is not None:
-                    gallery_lower.append(
-                        InputMedia(media_lower, item.caption, has_spoiler=spoiler)
-                    )
-
-            try:
-                for media_group in chunks(gallery, 10):
-                    await self.bot.send_media_group(chat_id=chat_id, media=media_group)
+            await self.send_gallery(
+                chat_id, submission.data.items, submission_poster.should_hide()
+            )
 
-            except BadRequest as e:
-                if not re.match(
-                    r"Failed to send message #\d+ with the error message \".*\"",
-                    e.message,
-                ):
-                    raise e
-                for media_group in chunks(gallery_lower, 10):
-                    await self.bot.send_media_group(chat_id=chat_id, media=media_group)
+    async def send_gallery(
+        self, chat_id: int | str, items: list[RedditGalleryMedia], spoiler: bool
+    ):
+        for item in items:
+            if item.type not in ("Image", "AnimatedImage"):
+                raise Exception(f"Unsupported gallery media type ({item.type})")
+
+        download_slots = asyncio.Semaphore(GALLERY_CONCURRENCY)
+        cached_keys = []
+        downloads: list[Path] = []
+
+        async def prepare(item: RedditGalleryMedia, lower: bool = False):
+            url = item.media_lower if lower else item.media
+            if url is None:
+                return None
+            file_id = None if lower else self.file_ids.get(url)
+            if file_id is not None:
+                cached_keys.append(url)
+                media = file_id
+            elif item.type == "AnimatedImage":
+                async with download_slots:
+                    media = await self.download(url, "gallery")
+                downloads.append(media)
+            else:
+                media = url
+            InputMedia = InputMediaPhoto if item.type == "Image" else InputMediaVideo
+            return InputMedia(media, item.caption, has_spoiler=spoiler)
+
+        # every download starts right away, each group is sent as soon as its
+        # own items are ready while the later ones keep downloading
+        prepared = [asyncio.create_task(prepare(item)) for item in items]
+        start = 0
+        try:
+            for start in range(0, len(items), 10):
+                media_group = [await task for task in prepared[start : start + 10]]
+                messages = await self.bot.send_media_group(
+                    chat_id=chat_id, media=media_group
+                )
+                for item, message in zip(items[start:], messages):
+                    if file_id := self.get_file_id(message):
+                        self.file_ids.set(item.media, file_id)
+
+        except BadRequest as e:
+            if not re.match(
+                r"Failed to send message #\d+ with the error message \".*\"",
+                e.message,
+            ):
+                raise e
+            # a stale file_id fails the whole group, don't trust them next time
+            for key in cached_keys:
+                self.file_ids.invalidate(key)
+            # the lower resolutions are only fetched when they're actually needed,
+            # starting from the group that failed
+            gallery_lower = [
+                media
+                for media in await asyncio.gather(
+                    *(prepare(item, lower=True) for item in items[start:])
+                )
+                if media is not None
+            ]
+            for media_group in chunks(gallery_lower, 10):
+                await self.bot.send_media_group(chat_id=chat_id, media=media_group)
+        finally:
+            for task in prepared:
+                task.cancel()
+            for path in downloads:
+                media_cache.release(path)
 
 
 async def main():
@@ -0,0 +1,28 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class CycleStats:
+    """Collects how long each stage of a channel cycle took"""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.durations: defaultdict[str, list[float]] = defaultdict(list)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage].append(perf_counter() - start)
+
+    def summary(self) -> str:
+        parts = [f"cycle {perf_counter() - self.started:.1f}s"]
+        for stage, durations in self.durations.items():
+            parts.append(
+                f"{stage}: n={len(durations)} total={sum(durations):.1f}s "
+                f"max={max(durations):.1f}s"
+            )
+        return ", ".join(parts)
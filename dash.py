@@ -0,0 +1,100 @@
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+
+@dataclass
+class Rendition:
+    url: str
+    bandwidth: int | None = None
+    audio: bool = False
+
+    def estimated_size(self, duration: float | None) -> int | None:
+        if self.bandwidth is None or not duration:
+            return None
+        return int(self.bandwidth * duration / 8)
+
+
+def local_name(tag: str):
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_duration(duration: str | None) -> float | None:
+    """Parses the ISO 8601 durations used by mediaPresentationDuration"""
+    if not duration:
+        return None
+    match = re.fullmatch(
+        r"P(?:(\d+(?:\.\d+)?)D)?T?(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?(?:(\d+(?:\.\d+)?)S)?",
+        duration,
+    )
+    if not match:
+        return None
+    days, hours, minutes, seconds = (float(g or 0) for g in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_manifest(
+    manifest: str, base_url: str
+) -> tuple[list[Rendition], list[Rendition], float | None]:
+    """Returns the video and audio renditions (best first) and the duration"""
+    root = ET.fromstring(manifest)
+    duration = parse_duration(root.get("mediaPresentationDuration"))
+    videos: list[Rendition] = []
+    audios: list[Rendition] = []
+    for adaptation_set in root.iter():
+        if local_name(adaptation_set.tag) != "AdaptationSet":
+            continue
+        content_type = (
+            adaptation_set.get("contentType") or adaptation_set.get("mimeType") or ""
+        )
+        for representation in adaptation_set:
+            if local_name(representation.tag) != "Representation":
+                continue
+            base_urls = [
+                child.text.strip()
+                for child in representation
+                if local_name(child.tag) == "BaseURL" and child.text
+            ]
+            if not base_urls:
+                continue
+            bandwidth = representation.get("bandwidth")
+            audio = "audio" in (
+                content_type + (representation.get("mimeType") or "")
+            ) or ("AUDIO" in base_urls[0])
+            rendition = Rendition(
+                f"{base_url}/{base_urls[0]}",
+                int(bandwidth) if bandwidth else None,
+                audio,
+            )
+            (audios if audio else videos).append(rendition)
+    videos.sort(key=lambda r: r.bandwidth or 0, reverse=True)
+    audios.sort(key=lambda r: r.bandwidth or 0, reverse=True)
+    return videos, audios, duration
+
+
+def select_renditions(
+    videos: list[Rendition],
+    audios: list[Rendition],
+    sizes: dict[str, int | None],
+    duration: float | None,
+    limit: int,
+) -> tuple[Rendition, Rendition] | None:
+    """Picks the best video and audio pair whose combined size is under `limit`
+
+    `sizes` holds the probed sizes, renditions that couldn't be probed fall
+    back to the size estimated from their bandwidth.
+    """
+
+    def size(rendition: Rendition):
+        probed = sizes.get(rendition.url)
+        return probed if probed is not None else rendition.estimated_size(duration)
+
+    video_sizes = [(video, size(video)) for video in videos]
+    for audio in audios:
+        audio_size = size(audio)
+        if audio_size is None:
+            continue
+        for video, video_size in video_sizes:
+            if video_size is not None and video_size + audio_size < limit:
+                return video, audio
+    return None
@@ -0,0 +1,130 @@
+import asyncio
+import importlib.util
+import logging
+import os
+from collections import defaultdict
+from httpx import (
+    AsyncBaseTransport,
+    AsyncByteStream,
+    AsyncClient,
+    AsyncHTTPTransport,
+    ByteStream,
+    Limits,
+    Request,
+    Response,
+    Timeout,
+)
+
+logger = logging.getLogger("http")
+
+__import__("dotenv").load_dotenv()
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS") or 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS") or 20)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY") or 60)
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST") or 10)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT") or 30)
+
+_client: AsyncClient | None = None
+
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+class _ReleasingStream(AsyncByteStream):
+    def __init__(self, stream: AsyncByteStream, semaphore: asyncio.Semaphore):
+        self.stream = stream
+        self.semaphore = semaphore
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.semaphore.release()
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+        finally:
+            self.release()
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class HostLimitedTransport(AsyncBaseTransport):
+    """Caps the number of in-flight requests per host on top of the pool limits"""
+
+    def __init__(self, transport: AsyncBaseTransport, max_per_host: int):
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.semaphores: defaultdict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self.max_per_host)
+        )
+
+    async def handle_async_request(self, request: Request) -> Response:
+        semaphore = self.semaphores[request.url.host]
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        if isinstance(response.stream, ByteStream):
+            # the body is already in memory, nothing left to hold the slot for
+            semaphore.release()
+        else:
+            # the slot is held until the body has been read and the response closed
+            response.stream = _ReleasingStream(response.stream, semaphore)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_client(transport: AsyncBaseTransport | None = None) -> AsyncClient:
+    """`transport` replaces the network, for recording or replaying requests"""
+    http2 = http2_available() and transport is None
+    if transport is None:
+        transport = AsyncHTTPTransport(
+            http2=http2,
+            limits=Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    if HTTP_MAX_CONNECTIONS_PER_HOST > 0:
+        transport = HostLimitedTransport(transport, HTTP_MAX_CONNECTIONS_PER_HOST)
+    logger.info(f"Creating shared http client (http2={http2})")
+    return AsyncClient(
+        transport=transport,
+        timeout=Timeout(HTTP_TIMEOUT),
+    )
+
+
+async def open_client(transport: AsyncBaseTransport | None = None) -> AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client(transport)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        # scripts that never go through post_init still get a client
+        _client = create_client()
+    return _client
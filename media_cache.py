@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path, PurePosixPath
+from httpx import AsyncClient, URL
+
+logger = logging.getLogger("media_cache")
+
+__import__("dotenv").load_dotenv()
+
+MEDIA_CACHE_DIR = Path(
+    os.getenv("MEDIA_CACHE_DIR") or Path(tempfile.gettempdir(), "reddit2telegram-media")
+)
+MEDIA_CACHE_SIZE_MB = float(os.getenv("MEDIA_CACHE_SIZE_MB") or 1024)
+MEDIA_CACHE_FRESH_FOR = float(os.getenv("MEDIA_CACHE_FRESH_FOR") or 3600)
+
+
+class CacheEntry:
+    def __init__(
+        self,
+        path: Path,
+        size: int,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        validated: float = 0,
+    ):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated = validated
+
+
+class MediaCache:
+    """Downloads media to disk, keeping the most recently used files
+
+    Entries younger than `fresh_for` seconds are served without touching the
+    network, older ones are revalidated with If-None-Match/If-Modified-Since.
+    Concurrent fetches of the same url share a single download, and the
+    least recently used files are deleted once the cache grows past
+    `max_size` bytes. Every path returned by `fetch` stays on disk until it
+    is given back with `release`, so files waiting to be uploaded are never
+    evicted.
+    """
+
+    def __init__(self, directory: Path, max_size: int, fresh_for: float):
+        self.directory = directory
+        self.max_size = max_size
+        self.fresh_for = fresh_for
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.inflight: dict[str, asyncio.Task[Path]] = {}
+        # the number of fetched paths of every key that haven't been released
+        self.users: dict[str, int] = {}
+        self.size = 0
+        self.loaded = False
+
+    def load(self):
+        """Indexes the files left over from previous runs, oldest first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.iterdir():
+            if path.name.startswith("tmp"):
+                path.unlink(missing_ok=True)
+            elif path.is_file():
+                stat = path.stat()
+                files.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(files):
+            self.entries[path.stem] = CacheEntry(path, size, validated=mtime)
+            self.size += size
+        self.loaded = True
+
+    @staticmethod
+    def key(url: str):
+        return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+    def path_for(self, url: str):
+        suffix = PurePosixPath(URL(url).path).suffix[:8]
+        return self.directory / f"{self.key(url)}{suffix}"
+
+    async def fetch(self, client: AsyncClient, url: str) -> Path:
+        if not self.loaded:
+            self.load()
+        key = self.key(url)
+        if key not in self.inflight:
+            task = asyncio.create_task(self.download(client, url, key))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # counted from the start, so another download finishing in the
+        # meantime can't evict it before the caller gets the path
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            # shielded so that one cancelled caller doesn't cancel the others
+            return await asyncio.shield(self.inflight[key])
+        except BaseException:
+            self.release_key(key)
+            raise
+
+    def release(self, path: Path):
+        """Gives back a path returned by `fetch` once it has been uploaded"""
+        self.release_key(path.stem)
+        self.evict()
+
+    def release_key(self, key: str):
+        if self.users.get(key, 0) > 1:
+            self.users[key] -= 1
+        else:
+            self.users.pop(key, None)
+
+    async def download(self, client: AsyncClient, url: str, key: str) -> Path:
+        entry = self.entries.get(key)
+        if entry is not None and not entry.path.exists():
+            self.remove(key)
+            entry = None
+        if entry is not None and time.time() - entry.validated < self.fresh_for:
+            self.entries.move_to_end(key)
+            return entry.path
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        async with client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and entry is not None:
+                entry.validated = time.time()
+                self.entries.move_to_end(key)
+                return entry.path
+            response.raise_for_status()
+            path = self.path_for(url)
+            fd, temp_path = tempfile.mkstemp(prefix="tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in response.aiter_bytes():
+                        f.write(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                Path(temp_path).unlink(missing_ok=True)
+                raise
+
+        if key in self.entries:
+            self.remove(key, unlink=False)
+        size = path.stat().st_size
+        self.entries[key] = CacheEntry(
+            path,
+            size,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            time.time(),
+        )
+        self.size += size
+        self.evict()
+        return path
+
+    def remove(self, key: str, unlink: bool = True):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        if unlink:
+            entry.path.unlink(missing_ok=True)
+
+    def evict(self):
+        # the newest entry is never evicted, even if it's bigger than the budget,
+        # and neither are the ones still in use
+        for key in list(self.entries)[:-1]:
+            if self.size <= self.max_size:
+                break
+            if key not in self.users:
+                self.remove(key)
+
+
+media_cache = MediaCache(
+    MEDIA_CACHE_DIR, int(MEDIA_CACHE_SIZE_MB * 1_000_000), MEDIA_CACHE_FRESH_FOR
+)
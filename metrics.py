@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from reddit_types import RedditSubmission
+
+logger = logging.getLogger("metrics")
+
+__import__("dotenv").load_dotenv()
+
+# 0 turns the endpoint off
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 9464)
+METRICS_HOST = os.getenv("METRICS_HOST") or "127.0.0.1"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def label_key(labels: dict[str, object]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(labels)} {value:g}")
+        return lines
+
+    def summary(self) -> str | None:
+        if not self.values:
+            return None
+        return f"{self.name}: {self.total():g}"
+
+
+class HistogramSeries:
+    def __init__(self, buckets: tuple[float, ...]):
+        # counts[i] is the number of observations in (buckets[i - 1], buckets[i]]
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series: dict[tuple[tuple[str, str], ...], HistogramSeries] = {}
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = HistogramSeries(self.buckets)
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(
+                    f"{self.name}_bucket{format_labels(labels + (('le', le),))} "
+                    f"{cumulative}"
+                )
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series.sum:g}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series.count}")
+        return lines
+
+    def quantile(self, q: float, counts: list[int]) -> float:
+        """Estimated from the buckets, like Prometheus' histogram_quantile"""
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+    def summary(self) -> str | None:
+        if not self.series:
+            return None
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for series in self.series.values():
+            counts = [a + b for a, b in zip(counts, series.counts)]
+            total += series.sum
+        n = sum(counts)
+        return (
+            f"{self.name}: n={n} mean={total / n:.2f}s "
+            f"p50={self.quantile(0.5, counts):.2f}s "
+            f"p95={self.quantile(0.95, counts):.2f}s"
+        )
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        metric = Histogram(name, help, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """The Prometheus text exposition format"""
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+    def summary(self) -> str:
+        lines = [line for m in self.metrics if (line := m.summary())]
+        return "\n".join(lines) or "Nothing measured yet"
+
+
+registry = Registry()
+
+listing_fetch_seconds = registry.histogram(
+    "reddit2telegram_listing_fetch_seconds",
+    "Time spent fetching a subreddit listing",
+)
+prepare_seconds = registry.histogram(
+    "reddit2telegram_prepare_seconds",
+    "Time spent parsing a submission and preparing its media",
+)
+media_probe_seconds = registry.histogram(
+    "reddit2telegram_media_probe_seconds",
+    "Time spent probing the sizes of a submission's renditions",
+)
+mux_seconds = registry.histogram(
+    "reddit2telegram_mux_seconds", "Time spent muxing a video with ffmpeg"
+)
+download_seconds = registry.histogram(
+    "reddit2telegram_download_seconds", "Time spent downloading a media file"
+)
+send_seconds = registry.histogram(
+    "reddit2telegram_send_seconds",
+    "Time spent sending a submission to Telegram, rate limit waits included",
+)
+rate_limit_wait_seconds = registry.histogram(
+    "reddit2telegram_rate_limit_wait_seconds",
+    "Time a Telegram request waited for the rate limiter",
+)
+submissions_sent = registry.counter(
+    "reddit2telegram_submissions_sent_total", "Submissions sent to Telegram"
+)
+submissions_failed = registry.counter(
+    "reddit2telegram_submissions_failed_total", "Submissions that failed to send"
+)
+retry_after_errors = registry.counter(
+    "reddit2telegram_retry_after_total", "RetryAfter errors returned by Telegram"
+)
+
+
+def media_type(submission: RedditSubmission | None) -> str:
+    if submission is None:
+        return "none"
+    if submission.data is None:
+        return "text"
+    return type(submission.data).__name__.removeprefix("Reddit").lower()
+
+
+class MetricsServer:
+    """Serves the registry at /metrics, for Prometheus to scrape"""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self.server: asyncio.Server | None = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # the headers aren't needed, but have to be read
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status = "200 OK"
+                body = registry.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            head = (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        if not self.port:
+            return
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            logger.warning(f"Metrics endpoint not started: {e}")
+            return
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+metrics_server = MetricsServer()
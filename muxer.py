@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from metrics import mux_seconds
+
+ffmpeg_logger = logging.getLogger("ffmpeg")
+
+__import__("dotenv").load_dotenv()
+
+FFMPEG_WORKDIR = Path(
+    os.getenv("FFMPEG_WORKDIR") or Path(tempfile.gettempdir(), "reddit2telegram")
+)
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT") or 300)
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY") or os.cpu_count() or 1)
+
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+
+class FFmpegError(Exception):
+    pass
+
+
+@functools.cache
+def ffmpeg_installed():
+    return shutil.which("ffmpeg") is not None
+
+
+async def run_ffmpeg(*args: str, timeout: float = FFMPEG_TIMEOUT):
+    async with ffmpeg_slots:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except BaseException:
+            # timeouts and cancellations must not leave the child running
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    output = f"{stdout.decode(errors='replace')}\n{stderr.decode(errors='replace')}"
+    if not output.isspace():
+        ffmpeg_logger.info(output)
+    if process.returncode:
+        raise FFmpegError(f"ffmpeg exited with code {process.returncode}")
+
+
+def temp_path(suffix: str) -> Path:
+    FFMPEG_WORKDIR.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=FFMPEG_WORKDIR)
+    os.close(fd)
+    return Path(path)
+
+
+async def mux(video_url: str, audio_url: str) -> Path:
+    """Muxes the video and audio streams into a new temporary mp4 file"""
+    path = temp_path(".mp4")
+    try:
+        with mux_seconds.time():
+            await run_ffmpeg(
+                "-i",
+                video_url,
+                "-i",
+                audio_url,
+                "-y",
+                "-v",
+                "warning",
+                "-c",
+                "copy",
+                str(path),
+            )
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
@@ -0,0 +1,57 @@
+from html.parser import HTMLParser
+from httpx import AsyncClient
+import json
+
+PLAYER_TAG = "<shreddit-player"
+
+
+class PackagedMediaParser(HTMLParser):
+    """Picks the packaged-media-json attribute out of a post page
+
+    The page is fed in chunks as it's downloaded; `found` is set as soon as
+    the <shreddit-player> tag has been parsed, so the rest of the page
+    doesn't need to be read.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found = False
+        self.media: dict | None = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        if tag != "shreddit-player" or self.found:
+            return
+        for name, value in attrs:
+            if name == "packaged-media-json" and value:
+                # attribute values come already unescaped
+                self.media = json.loads(value)
+                self.found = True
+                return
+
+
+async def fetch_packaged_media(
+    client: AsyncClient, url: str, headers: dict[str, str] | None = None
+) -> dict | None:
+    """Streams the page at `url` until its packaged media has been found
+
+    Returns None if the page has no <shreddit-player> with packaged media.
+    """
+    parser = PackagedMediaParser()
+    # everything before the player is skipped with a plain substring search,
+    # only the player tag itself goes through the parser
+    pending: str | None = ""
+    async with client.stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        async for text in response.aiter_text():
+            if pending is not None:
+                pending += text
+                start = pending.find(PLAYER_TAG)
+                if start == -1:
+                    # keep enough to match a tag split across two chunks
+                    pending = pending[-len(PLAYER_TAG) :]
+                    continue
+                text, pending = pending[start:], None
+            parser.feed(text)
+            if parser.found:
+                break
+    return parser.media
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Coroutine
+from reddit_types import RedditSubmission
+
+logger = logging.getLogger("prefetch")
+
+Prepare = Callable[[], Coroutine[None, None, RedditSubmission | None]]
+
+
+class Preparer:
+    """Parses submissions and stages their media ahead of the send
+
+    `prefetch()` starts preparing a submission in the background, as long as
+    fewer than `max_ready` payloads are already waiting; `acquire()` returns
+    a future of the payload, preparing it right away if nobody did. Every `acquire()` is
+    paired with a `release()`, and a payload is cleaned up once the last user
+    released it. Prefetched payloads that nobody picked up within `max_age`
+    seconds are dropped.
+    """
+
+    def __init__(self, concurrency: int, max_ready: int, max_age: float = 2 * 3600):
+        self.max_ready = max_ready
+        self.max_age = max_age
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks: dict[str, asyncio.Task[RedditSubmission | None]] = {}
+        self.created: dict[str, float] = {}
+        self.users: dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    async def run(self, prepare: Prepare):
+        async with self.slots:
+            return await prepare()
+
+    def start(self, submission_id: str, prepare: Prepare):
+        if submission_id not in self.tasks:
+            self.tasks[submission_id] = asyncio.create_task(self.run(prepare))
+            self.created[submission_id] = time.monotonic()
+
+    def prefetch(self, submission_id: str, prepare: Prepare) -> bool:
+        self.expire()
+        if submission_id in self.tasks:
+            return True
+        if len(self.tasks) >= self.max_ready:
+            return False
+        self.start(submission_id, prepare)
+        return True
+
+    def acquire(
+        self, submission_id: str, prepare: Prepare
+    ) -> asyncio.Future[RedditSubmission | None]:
+        self.start(submission_id, prepare)
+        self.users[submission_id] = self.users.get(submission_id, 0) + 1
+        # shielded so that one cancelled user doesn't cancel it for the others
+        return asyncio.shield(self.tasks[submission_id])
+
+    def release(self, submission_id: str):
+        users = self.users.get(submission_id, 0) - 1
+        if users > 0:
+            self.users[submission_id] = users
+            return
+        self.users.pop(submission_id, None)
+        self.drop(submission_id)
+
+    def drop(self, submission_id: str):
+        task = self.tasks.pop(submission_id, None)
+        self.created.pop(submission_id, None)
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and task.result():
+            task.result().cleanup()
+
+    def expire(self):
+        oldest = time.monotonic() - self.max_age
+        for submission_id, created in list(self.created.items()):
+            if created < oldest and submission_id not in self.users:
+                logger.info(f"Dropping prefetched submission {submission_id}")
+                self.drop(submission_id)
@@ -1,19 +1,115 @@
 from typing import Any, Callable, Coroutine, Dict, List
 from telegram.ext import BaseRateLimiter
 from telegram.error import RetryAfter
+from metrics import rate_limit_wait_seconds, retry_after_errors
 import asyncio
 import logging
+import time
 
 logger = logging.getLogger("ratelimiter")
 
 
-class RateLimiter(BaseRateLimiter):
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, cost: float = 1) -> float:
+        """Waits until `cost` tokens are available, returns the time spent waiting"""
+        cost = min(cost, self.capacity)
+        waited = 0.0
+        # the lock keeps waiters in FIFO order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.refill()
+                    if self.tokens >= cost:
+                        self.tokens -= cost
+                        return waited
+                    delay = (cost - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+class RateLimiter(BaseRateLimiter[int]):
+    """Throttles requests before they hit Telegram's flood limits
+
+    Every request with a chat_id draws from a global bucket (~30 msg/s) and
+    from a bucket of its chat (~20 msg/min for groups and channels, ~1 msg/s
+    for private chats). A media group costs one token per item.
+    `rate_limit_args` overrides the number of retries after a RetryAfter.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        group_rate: float = 20 / 60,
+        group_burst: float = 20,
+        private_rate: float = 1,
+        private_burst: float = 1,
+        max_retries: int = 3,
+    ):
+        self.overall_rate = overall_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_retries = max_retries
+        self.overall_bucket = TokenBucket(overall_rate, overall_rate)
+        self.chat_buckets: dict[str | int, TokenBucket] = {}
+
     async def initialize(self) -> None:
         pass
 
     async def shutdown(self) -> None:
         pass
 
+    @staticmethod
+    def get_chat_id(data: Dict[str, Any]) -> str | int | None:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return None
+        try:
+            return int(chat_id)
+        except ValueError:
+            return chat_id
+
+    @staticmethod
+    def is_group(chat_id: str | int):
+        # string chat_ids are @usernames, which only exist for channels and supergroups
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def get_chat_bucket(self, chat_id: str | int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            if self.is_group(chat_id):
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self.chat_buckets[chat_id] = bucket
+        return self.chat_buckets[chat_id]
+
+    @staticmethod
+    def get_cost(endpoint: str, data: Dict[str, Any]) -> int:
+        if endpoint == "sendMediaGroup":
+            return max(1, len(data.get("media") or ()))
+        return 1
+
     async def process_request(
         self,
         callback: Callable[
@@ -23,11 +119,38 @@ class RateLimiter(BaseRateLimiter):
         kwargs: Dict[str, Any],
         endpoint: str,
         data: Dict[str, Any],
-        rate_limit_args: Any | None,
+        rate_limit_args: int | None,
     ) -> bool | Dict[str, Any] | List[Dict[str, Any]]:
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = self.get_chat_id(data)
+        cost = self.get_cost(endpoint, data)
+        retries = 0
         while True:
+            if chat_id is not None:
+                chat_bucket = self.get_chat_bucket(chat_id)
+                waited = await chat_bucket.acquire(cost)
+                waited += await self.overall_bucket.acquire(cost)
+                rate_limit_wait_seconds.observe(
+                    waited,
+                    endpoint=endpoint,
+                    chat=chat_id,
+                    chat_type="group" if self.is_group(chat_id) else "private",
+                )
             try:
                 return await callback(*args, **kwargs)
             except RetryAfter as e:
-                logger.warning(e)
-                await asyncio.sleep(e.retry_after)
+                retry_after_errors.inc(endpoint=endpoint, chat=chat_id)
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                if retries >= max_retries:
+                    logger.error(
+                        f"{endpoint} to {chat_id} failed after {retries} retries"
+                    )
+                    raise
+                retries += 1
+                logger.warning(f"{e} ({endpoint} to {chat_id}, retry {retries})")
+                if chat_id is not None:
+                    self.get_chat_bucket(chat_id).block(retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
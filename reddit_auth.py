@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import os
+import time
+from httpx import AsyncClient
+
+logger = logging.getLogger("reddit_auth")
+
+__import__("dotenv").load_dotenv()
+
+REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
+REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
+
+
+class TokenManager:
+    """Caches the application-only OAuth token until shortly before it expires"""
+
+    def __init__(
+        self,
+        client_id: str | None,
+        client_secret: str | None,
+        expiry_margin: float = 60,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.expiry_margin = expiry_margin
+        self.access_token: str | None = None
+        self.expires_at = 0.0
+        self.lock = asyncio.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.client_id and self.client_secret)
+
+    def valid(self):
+        return (
+            self.access_token is not None
+            and time.monotonic() < self.expires_at - self.expiry_margin
+        )
+
+    async def get_token(self, client: AsyncClient) -> str | None:
+        if not self.enabled:
+            return None
+        if self.valid():
+            return self.access_token
+        async with self.lock:
+            # another caller may have refreshed it while we were waiting
+            if not self.valid():
+                await self.refresh(client)
+            return self.access_token
+
+    async def invalidate(self, client: AsyncClient, rejected_token: str | None):
+        """Refreshes the token after a 401, unless someone already did"""
+        async with self.lock:
+            if self.access_token == rejected_token:
+                await self.refresh(client)
+            return self.access_token
+
+    async def refresh(self, client: AsyncClient):
+        req = await client.post(
+            "https://www.reddit.com/api/v1/access_token",
+            data={"grant_type": "client_credentials"},
+            auth=(self.client_id, self.client_secret),
+            headers={"User-Agent": "kyryh/reddit2telegram"},
+        )
+        req.raise_for_status()
+        data = req.json()
+        self.access_token = data["access_token"]
+        self.expires_at = time.monotonic() + float(data.get("expires_in", 3600))
+        logger.info(
+            f"Refreshed reddit access token (expires in {data.get('expires_in')}s)"
+        )
+
+
+token_manager = TokenManager(REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET)
@@ -0,0 +1,201 @@
+import importlib.util
+import json
+import logging
+import os
+from typing import Any, Callable, TypedDict
+from reddit_types import slim_submission
+
+logger = logging.getLogger("reddit_json")
+
+__import__("dotenv").load_dotenv()
+
+# auto picks the fastest installed one: msgspec, orjson, then the stdlib
+JSON_DECODER = (os.getenv("JSON_DECODER") or "auto").lower()
+# with msgspec, listings are decoded straight into the fields parse_submission reads
+TYPED_LISTINGS = (os.getenv("TYPED_LISTINGS") or "1") not in ("0", "false")
+
+DECODERS = ("msgspec", "orjson", "json")
+
+
+def available_decoders() -> list[str]:
+    return [
+        name
+        for name in DECODERS
+        if name == "json" or importlib.util.find_spec(name) is not None
+    ]
+
+
+def choose_decoder(name: str) -> str:
+    available = available_decoders()
+    if name == "auto":
+        return available[0]
+    if name not in available:
+        logger.warning(f"JSON decoder {name} is not installed, using {available[0]}")
+        return available[0]
+    return name
+
+
+def get_loads(name: str) -> Callable[[bytes], Any]:
+    if name == "msgspec":
+        import msgspec
+
+        return msgspec.json.Decoder().decode
+    if name == "orjson":
+        import orjson
+
+        return orjson.loads
+    return json.loads
+
+
+# the schema of what parse_submission reads; everything else in a listing is
+# skipped by the decoder instead of being turned into python objects
+
+
+class Image(TypedDict, total=False):
+    url: str
+    width: int
+    height: int
+
+
+class ImageVariant(TypedDict, total=False):
+    source: Image
+    resolutions: list[Image]
+
+
+class PreviewImage(TypedDict, total=False):
+    source: Image
+    resolutions: list[Image]
+    variants: dict[str, ImageVariant]
+
+
+class VideoPreview(TypedDict, total=False):
+    fallback_url: str
+
+
+class Preview(TypedDict, total=False):
+    images: list[PreviewImage]
+    reddit_video_preview: VideoPreview
+
+
+class Video(TypedDict, total=False):
+    fallback_url: str
+    dash_url: str
+    width: int
+    height: int
+    duration: int
+
+
+class Media(TypedDict, total=False):
+    reddit_video: Video
+
+
+class GalleryItem(TypedDict, total=False):
+    media_id: str
+    caption: str
+
+
+class Gallery(TypedDict, total=False):
+    items: list[GalleryItem]
+
+
+class MediaSource(TypedDict, total=False):
+    u: str
+    gif: str
+    mp4: str
+
+
+class MediaMetadata(TypedDict, total=False):
+    status: str
+    e: str
+    s: MediaSource
+    p: list[MediaSource]
+
+
+class Submission(TypedDict, total=False):
+    id: str
+    name: str
+    title: str
+    permalink: str
+    score: int
+    link_flair_text: str | None
+    selftext_html: str | None
+    spoiler: bool
+    over_18: bool
+    subreddit: str
+    removed_by_category: str | None
+    crosspost_parent_list: list["Submission"]
+    is_self: bool
+    is_video: bool
+    is_gallery: bool
+    url: str
+    url_overridden_by_dest: str
+    preview: Preview
+    media: Media | None
+    gallery_data: Gallery | None
+    media_metadata: dict[str, MediaMetadata] | None
+
+
+class Child(TypedDict):
+    data: Submission
+
+
+class ListingData(TypedDict, total=False):
+    children: list[Child]
+    after: str | None
+    before: str | None
+
+
+class Listing(TypedDict):
+    data: ListingData
+
+
+class JSONDecoder:
+    """Decodes reddit's responses with the configured json library
+
+    `decode_listing` returns the entries of a listing, slimmed down to what
+    parse_submission reads, and its before and after cursors. In typed mode
+    msgspec never builds the rest of the listing; otherwise the full
+    response is decoded and slimmed afterwards.
+    """
+
+    def __init__(self, name: str = JSON_DECODER, typed: bool = TYPED_LISTINGS):
+        self.name = choose_decoder(name)
+        self.loads = get_loads(self.name)
+        self.typed = typed and self.name == "msgspec"
+        if self.typed:
+            import msgspec
+
+            self.validation_error = msgspec.ValidationError
+            self.listing_decoder = msgspec.json.Decoder(Listing)
+            self.submission_decoder = msgspec.json.Decoder(tuple[Listing, msgspec.Raw])
+
+    def decode(self, content: bytes) -> Any:
+        return self.loads(content)
+
+    def decode_listing(
+        self, content: bytes
+    ) -> tuple[list[dict], str | None, str | None]:
+        if self.typed:
+            try:
+                data = self.listing_decoder.decode(content)["data"]
+                entries = [child["data"] for child in data.get("children", [])]
+                return entries, data.get("before"), data.get("after")
+            except self.validation_error as e:
+                # reddit sent something the schema didn't expect, decode it all
+                logger.warning(f"Listing didn't match the schema: {e}")
+        data = self.loads(content)["data"]
+        entries = [slim_submission(child["data"]) for child in data["children"]]
+        return entries, data.get("before"), data.get("after")
+
+    def decode_submission(self, content: bytes) -> dict:
+        """The submission of a /comments/<id> response, without the comments"""
+        if self.typed:
+            try:
+                listing, _ = self.submission_decoder.decode(content)
+                return listing["data"]["children"][0]["data"]
+            except self.validation_error as e:
+                logger.warning(f"Submission didn't match the schema: {e}")
+        return slim_submission(self.loads(content)[0]["data"]["children"][0]["data"])
+
+
+json_decoder = JSONDecoder()
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import random
+import time
+from httpx import Response
+
+logger = logging.getLogger("reddit_ratelimit")
+
+
+class RedditRateGovernor:
+    """Keeps the reddit requests within the budget reported by X-Ratelimit-*
+
+    Requests go out freely while plenty of budget is left; once fewer than
+    `burst` requests remain, they're spaced evenly over what's left of the
+    reset window, and when the budget runs out they wait for the reset.
+    429s and 5xx responses are retried with exponential backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        burst: int = 20,
+        max_retries: int = 4,
+        base_backoff: float = 2,
+        max_backoff: float = 60,
+    ):
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.remaining: float | None = None
+        self.used: int | None = None
+        self.reset_at = 0.0
+        self.next_request_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.remaining is None or now >= self.reset_at:
+                return
+            if self.remaining < 1:
+                delay = self.reset_at - now
+                logger.warning(f"Reddit rate limit used up, waiting {delay:.0f}s")
+            elif self.remaining < self.burst:
+                spacing = (self.reset_at - now) / self.remaining
+                delay = max(0.0, self.next_request_at - now)
+                self.next_request_at = max(now, self.next_request_at) + spacing
+            else:
+                delay = 0.0
+            # the headers of this request's response will correct the estimate
+            self.remaining -= 1
+            if delay:
+                await asyncio.sleep(delay)
+
+    def update(self, response: Response):
+        headers = response.headers
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        self.remaining = remaining
+        self.reset_at = time.monotonic() + reset
+        used = headers.get("X-Ratelimit-Used")
+        self.used = int(used) if used and used.isdigit() else self.used
+
+    def should_retry(self, response: Response, attempt: int):
+        return attempt < self.max_retries and (
+            response.status_code == 429 or response.status_code >= 500
+        )
+
+    def backoff(self, response: Response, attempt: int) -> float:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after) + random.uniform(0, 1)
+        if response.status_code == 429 and self.remaining is not None:
+            return max(0.0, self.reset_at - time.monotonic()) + random.uniform(0, 1)
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2**attempt))
+
+    def status(self) -> str:
+        if self.remaining is None:
+            return "unknown"
+        reset = max(0.0, self.reset_at - time.monotonic())
+        return f"{self.remaining:.0f} left, {self.used} used, resets in {reset:.0f}s"
+
+
+governor = RedditRateGovernor()
@@ -1,76 +1,127 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# the keys of a listing entry that parse_submission reads
+SUBMISSION_FIELDS = (
+    "id",
+    "name",
+    "title",
+    "permalink",
+    "score",
+    "link_flair_text",
+    "selftext_html",
+    "spoiler",
+    "over_18",
+    "subreddit",
+    "removed_by_category",
+    "crosspost_parent_list",
+    "is_self",
+    "is_video",
+    "is_gallery",
+    "url",
+    "url_overridden_by_dest",
+    "preview",
+    "media",
+    "gallery_data",
+    "media_metadata",
+)
+
+
+def slim_submission(s: dict) -> dict:
+    """Drops everything parse_submission doesn't read from a listing entry, so
+    the rest of the decoded response can be freed right away"""
+    slim = {key: s[key] for key in SUBMISSION_FIELDS if key in s}
+    if slim.get("crosspost_parent_list"):
+        slim["crosspost_parent_list"] = [
+            slim_submission(slim["crosspost_parent_list"][0])
+        ]
+    return slim
+
+
+@dataclass(slots=True)
 class RedditSubmission:
-    def __init__(
-        self,
-        title: str,
-        id: str,
-        permalink: str,
-        score: int,
-        flair: str | None,
-        text: str,
-        spoiler: bool,
-        nsfw: bool,
-    ):
-        self.title = title
-        self.id = id
-        self.score = score
-        self.flair = flair
-        self.text = text
-        self.post_url = "https://redd.it/" + id
-        self.post_url_long = "https://www.reddit.com" + permalink
-        self.spoiler = spoiler
-        self.nsfw = nsfw
-        self.data: "RedditData | None" = None
+    title: str
+    id: str
+    permalink: str
+    score: int
+    flair: str | None
+    text: str
+    spoiler: bool
+    nsfw: bool
+    data: "RedditData | None" = None
+
+    @classmethod
+    def from_listing(cls, s: dict, text: str = "") -> "RedditSubmission":
+        """`text` is the selftext, already made into Telegram HTML"""
+        return cls(
+            s["title"],
+            s["id"],
+            s["permalink"],
+            s["score"],
+            s["link_flair_text"],
+            text,
+            s["spoiler"],
+            s["over_18"],
+        )
 
+    @property
+    def post_url(self):
+        return "https://redd.it/" + self.id
 
+    @property
+    def post_url_long(self):
+        return "https://www.reddit.com" + self.permalink
+
+    def cleanup(self):
+        if self.data:
+            self.data.cleanup()
+
+
+@dataclass(slots=True)
 class RedditData:
-    pass
+    # id of the submission the media comes from, crossposts share their parent's
+    media_id: str | None = field(default=None, kw_only=True)
 
+    def cleanup(self):
+        pass
 
+
+@dataclass(slots=True)
 class RedditVideo(RedditData):
-    def __init__(
-        self,
-        resolutions: list[str | bytes],
-        width: int = None,
-        height: int = None,
-        duration: int = None,
-        thumbnail: str = None,
-    ):
-        super().__init__()
-        self.resolutions = resolutions
-        self.width = width
-        self.height = height
-        self.duration = duration
-        self.thumbnail = thumbnail
+    resolutions: list[str | bytes | Path]
+    width: int | None = None
+    height: int | None = None
+    duration: int | None = None
+    thumbnail: str | None = None
+
+    def cleanup(self):
+        # muxed videos live in temporary files until they have been sent
+        for resolution in self.resolutions:
+            if isinstance(resolution, Path):
+                resolution.unlink(missing_ok=True)
 
 
+@dataclass(slots=True)
 class RedditGallery(RedditData):
-    def __init__(self, items: list["RedditGalleryMedia"]):
-        super().__init__()
-        self.items = items
+    items: list["RedditGalleryMedia"]
 
 
+@dataclass(slots=True)
 class RedditGalleryMedia:
-    def __init__(self, media: str, media_lower: str, type: str, caption: str):
-        self.media = media
-        self.media_lower = media_lower
-        self.type = type
-        self.caption = caption
+    media: str
+    media_lower: str
+    type: str
+    caption: str
 
 
+@dataclass(slots=True)
 class RedditGif(RedditData):
-    def __init__(
-        self,
-        resolutions: list[str],
-        width: int = None,
-        height: int = None,
-        thumbnail: str = None,
-    ):
-        self.resolutions = resolutions
-        self.width = width
-        self.height = height
-        self.thumbnail = thumbnail
+    resolutions: list[str]
+    width: int | None = None
+    height: int | None = None
+    thumbnail: str | None = None
 
 
+@dataclass(slots=True)
 class RedditImage(RedditData):
-    def __init__(self, resolutions: list[str]):
-        self.resolutions = resolutions
+    resolutions: list[str]
@@ -0,0 +1,71 @@
+from base_posters import Poster
+
+
+def listing_key(poster: type[Poster]) -> tuple[str, str]:
+    subreddits = "+".join(sorted(set(poster.subreddits.lower().split("+"))))
+    return subreddits, poster.sort_by
+
+
+def plan_listings(posters: list[type[Poster]]) -> dict[tuple[str, str], int]:
+    """Maps every distinct listing to the biggest limit any poster wants from it
+
+    A listing is ordered the same whatever the limit, so the posters that
+    read the same subreddits with the same sort share one request and each
+    takes as many submissions as it asked for.
+    """
+    listings: dict[tuple[str, str], int] = {}
+    for poster in posters:
+        key = listing_key(poster)
+        listings[key] = max(listings.get(key, 0), poster.limit)
+    return listings
+
+
+class PosterSchedule:
+    """The posters that run together in one job, and how often they run"""
+
+    def __init__(self, posters: list[type[Poster]]):
+        first = posters[0]
+        self.posters = posters
+        self.interval: float = first.interval
+        self.adaptive = first.adaptive
+        self.min_interval = first.min_interval
+        self.max_interval = first.max_interval
+        self.interval = self.clamp(self.interval)
+
+    @property
+    def name(self):
+        return "+".join(poster.__name__ for poster in self.posters)
+
+    @property
+    def limit(self):
+        return sum(poster.limit for poster in self.posters)
+
+    def clamp(self, interval: float):
+        if not self.adaptive:
+            return interval
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def adapt(self, new_submissions: int) -> float:
+        """Polls more often when the last run found a lot, less when it found nothing"""
+        if new_submissions == 0:
+            self.interval = self.clamp(self.interval * 1.5)
+        elif new_submissions >= self.limit / 2:
+            self.interval = self.clamp(self.interval / 2)
+        return self.interval
+
+
+def plan_schedules(posters: list[type[Poster]]) -> list[PosterSchedule]:
+    """Gives every poster its own schedule, except for the posters that read the
+    same listing on the same schedule, which share one so the fetch isn't repeated
+    """
+    groups: dict[tuple, list[type[Poster]]] = {}
+    for poster in posters:
+        key = (
+            listing_key(poster),
+            poster.interval,
+            poster.adaptive,
+            poster.min_interval,
+            poster.max_interval,
+        )
+        groups.setdefault(key, []).append(poster)
+    return [PosterSchedule(group) for group in groups.values()]
@@ -0,0 +1,226 @@
+import logging
+import pickle
+import sqlite3
+from pathlib import Path
+from typing import Any
+from telegram.ext import BasePersistence, PersistenceInput
+from stores import RowStore
+
+logger = logging.getLogger("persistence")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS rows (
+    store TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (store, key)
+);
+CREATE TABLE IF NOT EXISTS data (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+
+def dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class SQLitePersistence(BasePersistence[dict, dict, dict]):
+    """Persistence on top of sqlite3 in WAL mode
+
+    bot_data values are stored one row per key and only rewritten when they
+    change. Values that are `RowStore`s (like the sent submissions) are
+    written incrementally, so the cost of a flush depends on what changed
+    since the last one, not on how much history has piled up.
+    If the database is new and `import_pickle` points to the file of a
+    `PicklePersistence`, its data is imported on the first load.
+    """
+
+    def __init__(
+        self,
+        filepath: str | Path,
+        import_pickle: str | Path | None = None,
+        store_data: PersistenceInput | None = None,
+        update_interval: float = 60,
+    ):
+        super().__init__(store_data, update_interval)
+        self.filepath = Path(filepath)
+        self.import_pickle = Path(import_pickle) if import_pickle else None
+        self.connection: sqlite3.Connection | None = None
+        self.bot_data_blobs: dict[str, bytes] = {}
+        self.row_stores: dict[str, RowStore] = {}
+        self.data_blobs: dict[tuple[str, str], bytes] = {}
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.connection is None:
+            new = not self.filepath.exists()
+            self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+            if new and self.import_pickle and self.import_pickle.exists():
+                self.import_pickle_file(self.import_pickle)
+        return self.connection
+
+    def import_pickle_file(self, path: Path):
+        logger.info(f"Importing {path} into {self.filepath}")
+        with path.open("rb") as f:
+            data = pickle.load(f)
+        with self.db:
+            for key, value in (data.get("bot_data") or {}).items():
+                self.write_bot_data_value(key, value)
+            for kind in ("user_data", "chat_data"):
+                for key, value in (data.get(kind) or {}).items():
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO data VALUES (?, ?, ?)",
+                        (kind, str(key), dumps(value)),
+                    )
+            if data.get("callback_data") is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO data VALUES (?, ?, ?)",
+                    ("callback_data", "", dumps(data["callback_data"])),
+                )
+            for name, conversations in (data.get("conversations") or {}).items():
+                self.db.execute(
+                    "INSERT OR REPLACE INTO data VALUES (?, ?, ?)",
+                    ("conversations", name, dumps(conversations)),
+                )
+
+    def write_bot_data_value(self, key: str, value: Any):
+        if isinstance(value, RowStore):
+            if self.row_stores.get(key) is value:
+                changes = value.drain_changes()
+                self.db.executemany(
+                    "DELETE FROM rows WHERE store = ? AND key = ?",
+                    [(key, k) for k, v in changes.items() if v is None],
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO rows VALUES (?, ?, ?)",
+                    [(key, k, dumps(v)) for k, v in changes.items() if v is not None],
+                )
+                return
+            # a store we haven't written yet (or one that replaced the old one)
+            self.db.execute("DELETE FROM rows WHERE store = ?", (key,))
+            self.db.executemany(
+                "INSERT INTO rows VALUES (?, ?, ?)",
+                [(key, k, dumps(v)) for k, v in value.rows()],
+            )
+            value.track_changes()
+            self.row_stores[key] = value
+            blob = dumps(value.shell())
+        else:
+            self.row_stores.pop(key, None)
+            blob = dumps(value)
+        if self.bot_data_blobs.get(key) != blob:
+            self.db.execute(
+                "INSERT OR REPLACE INTO bot_data VALUES (?, ?)", (key, blob)
+            )
+            self.bot_data_blobs[key] = blob
+
+    def write_bot_data(self, data: dict):
+        with self.db:
+            for key, value in data.items():
+                self.write_bot_data_value(key, value)
+            for key in self.bot_data_blobs.keys() - data.keys():
+                self.db.execute("DELETE FROM bot_data WHERE key = ?", (key,))
+                self.db.execute("DELETE FROM rows WHERE store = ?", (key,))
+                del self.bot_data_blobs[key]
+                self.row_stores.pop(key, None)
+
+    def load_data(self, kind: str) -> dict[str, Any]:
+        data = {}
+        for key, value in self.db.execute(
+            "SELECT key, value FROM data WHERE kind = ?", (kind,)
+        ):
+            self.data_blobs[kind, key] = value
+            data[key] = pickle.loads(value)
+        return data
+
+    def write_data(self, kind: str, key: str, value: Any):
+        blob = dumps(value)
+        if self.data_blobs.get((kind, key)) == blob:
+            return
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO data VALUES (?, ?, ?)", (kind, key, blob)
+            )
+        self.data_blobs[kind, key] = blob
+
+    def drop_data(self, kind: str, key: str):
+        with self.db:
+            self.db.execute("DELETE FROM data WHERE kind = ? AND key = ?", (kind, key))
+        self.data_blobs.pop((kind, key), None)
+
+    async def get_bot_data(self) -> dict:
+        bot_data = {}
+        for key, value in self.db.execute("SELECT key, value FROM bot_data"):
+            self.bot_data_blobs[key] = value
+            bot_data[key] = pickle.loads(value)
+        rows: dict[str, list[tuple[str, Any]]] = {}
+        for store, key, value in self.db.execute("SELECT store, key, value FROM rows"):
+            rows.setdefault(store, []).append((key, pickle.loads(value)))
+        for key, value in bot_data.items():
+            if isinstance(value, RowStore):
+                value.load_rows(rows.get(key, ()))
+                value.track_changes()
+                self.row_stores[key] = value
+        return bot_data
+
+    async def update_bot_data(self, data: dict) -> None:
+        self.write_bot_data(data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {int(k): v for k, v in self.load_data("user_data").items()}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self.write_data("user_data", str(user_id), data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.drop_data("user_data", str(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {int(k): v for k, v in self.load_data("chat_data").items()}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self.write_data("chat_data", str(chat_id), data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.drop_data("chat_data", str(chat_id))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> Any:
+        return self.load_data("callback_data").get("")
+
+    async def update_callback_data(self, data: Any) -> None:
+        self.write_data("callback_data", "", data)
+
+    async def get_conversations(self, name: str) -> dict:
+        return self.load_data("conversations").get(name, {})
+
+    async def update_conversation(
+        self, name: str, key: tuple, new_state: object | None
+    ) -> None:
+        conversations = self.load_data("conversations").get(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self.write_data("conversations", name, conversations)
+
+    async def flush(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
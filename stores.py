@@ -0,0 +1,275 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Iterable
+
+
+class RowStore(ABC):
+    """A bot_data value that the SQLite persistence writes row by row
+
+    Instead of pickling the whole object on every flush, the persistence
+    stores an empty `shell()` once and then only writes the rows returned
+    by `drain_changes()` (a None value means the row was deleted).
+    """
+
+    @abstractmethod
+    def rows(self) -> Iterable[tuple[str, Any]]:
+        pass
+
+    @abstractmethod
+    def load_rows(self, rows: Iterable[tuple[str, Any]]):
+        pass
+
+    @abstractmethod
+    def track_changes(self):
+        pass
+
+    @abstractmethod
+    def drain_changes(self) -> dict[str, Any]:
+        pass
+
+    @abstractmethod
+    def shell(self) -> "RowStore":
+        pass
+
+    def __deepcopy__(self, memo):
+        # the application deep copies bot_data before every flush, which would
+        # make each flush as expensive as the whole history
+        return self
+
+
+class DictRowStore(RowStore):
+    """A RowStore whose rows are the items of the `entries` dict
+
+    Subclasses call `changed(key)` after setting or deleting an entry.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, Any] = {}
+        self.changes: dict[str, Any] | None = None
+
+    def __getstate__(self):
+        return self.__dict__ | {"changes": None}
+
+    def changed(self, key: str):
+        if self.changes is not None:
+            self.changes[key] = self.entries.get(key)
+
+    def rows(self):
+        return self.entries.items()
+
+    def load_rows(self, rows):
+        self.entries.update(rows)
+
+    def track_changes(self):
+        self.changes = {}
+
+    def drain_changes(self):
+        changes, self.changes = self.changes or {}, {}
+        return changes
+
+
+class FileIdCache(DictRowStore):
+    """Maps reddit media (urls or submission ids) to the file_id Telegram gave it
+
+    Least recently used entries are dropped past `max_count`. Every entry
+    keeps when it was last used, so that the order survives a restart.
+    """
+
+    def __init__(self, max_count: int = 10000):
+        super().__init__()
+        self.max_count = max_count
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str | None) -> str | None:
+        if key is None or key not in self.entries:
+            return None
+        file_id, _ = self.entries.pop(key)
+        self.entries[key] = (file_id, time.time())
+        self.changed(key)
+        return file_id
+
+    def set(self, key: str, file_id: str):
+        self.entries.pop(key, None)
+        self.entries[key] = (file_id, time.time())
+        self.changed(key)
+        while len(self.entries) > self.max_count:
+            self.invalidate(next(iter(self.entries)))
+
+    def invalidate(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.changed(key)
+
+    def load_rows(self, rows):
+        # rows come back unordered, the timestamps restore the LRU order
+        super().load_rows(sorted(rows, key=lambda row: row[1][1]))
+
+    def shell(self):
+        return FileIdCache(self.max_count)
+
+
+class SubredditInfoCache(DictRowStore):
+    """Subreddit metadata by lowercase name, kept for `ttl` seconds
+
+    Names reddit returned nothing for are cached as None, so they aren't
+    asked for again on every lookup either.
+    """
+
+    fields = ("display_name", "over18", "subscribers")
+
+    def __init__(self, ttl: float = 24 * 3600):
+        super().__init__()
+        self.ttl = ttl
+
+    def lookup(self, names: Iterable[str]) -> tuple[dict[str, dict | None], list[str]]:
+        """Returns the cached info and the names that are missing or expired"""
+        found = {}
+        missing = []
+        now = time.time()
+        for name in names:
+            name = name.lower()
+            entry = self.entries.get(name)
+            if entry is None or now - entry[1] > self.ttl:
+                missing.append(name)
+            else:
+                found[name] = entry[0]
+        return found, missing
+
+    def set(self, name: str, info: dict | None):
+        self.entries[name.lower()] = (
+            {field: info.get(field) for field in self.fields} if info else None,
+            time.time(),
+        )
+        self.changed(name.lower())
+
+    def shell(self):
+        return SubredditInfoCache(self.ttl)
+
+
+class SubmissionHistory:
+    """Ids of the submissions already sent to a chat
+
+    Membership is a dict lookup, and the dict's insertion order doubles as
+    an LRU: ids are moved to the end whenever a listing shows them again,
+    and the least recently seen ones are evicted once there are more than
+    `max_count` of them or they haven't been seen for `max_age` seconds.
+    """
+
+    def __init__(self, max_count: int = 5000, max_age: float = 30 * 24 * 3600):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.ids: dict[str, float] = {}
+        self.changes: dict[str, float | None] | None = None
+
+    def __getstate__(self):
+        return self.__dict__ | {"changes": None}
+
+    def __contains__(self, submission_id: str):
+        return submission_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def seen(self, submission_id: str) -> bool:
+        """Returns whether the submission was already sent, refreshing its age if so"""
+        if submission_id not in self.ids:
+            return False
+        self.add(submission_id)
+        return True
+
+    def add(self, submission_id: str, timestamp: float | None = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self.ids.pop(submission_id, None)
+        self.ids[submission_id] = timestamp
+        if self.changes is not None:
+            self.changes[submission_id] = timestamp
+        self.evict()
+
+    def evict(self):
+        oldest = time.time() - self.max_age
+        while self.ids and (
+            len(self.ids) > self.max_count or next(iter(self.ids.values())) < oldest
+        ):
+            submission_id = next(iter(self.ids))
+            del self.ids[submission_id]
+            if self.changes is not None:
+                self.changes[submission_id] = None
+
+
+class SentSubmissions(RowStore, dict[str | int, SubmissionHistory]):
+    def __init__(self, max_count: int = 5000, max_age: float = 30 * 24 * 3600):
+        super().__init__()
+        self.max_count = max_count
+        self.max_age = max_age
+        self.tracking = False
+
+    def __getstate__(self):
+        return self.__dict__ | {"tracking": False}
+
+    def configure(self, max_count: int, max_age: float):
+        self.max_count = max_count
+        self.max_age = max_age
+        for history in self.values():
+            history.max_count = max_count
+            history.max_age = max_age
+            history.evict()
+
+    def __missing__(self, chat: str | int) -> SubmissionHistory:
+        history = self[chat] = SubmissionHistory(self.max_count, self.max_age)
+        if self.tracking:
+            history.changes = {}
+        return history
+
+    def rows(self):
+        for chat, history in self.items():
+            for submission_id, timestamp in history.ids.items():
+                yield json.dumps([chat, submission_id]), timestamp
+
+    def load_rows(self, rows):
+        histories: dict[str | int, list[tuple[float, str]]] = {}
+        for key, timestamp in rows:
+            chat, submission_id = json.loads(key)
+            histories.setdefault(chat, []).append((timestamp, submission_id))
+        for chat, entries in histories.items():
+            # rows come back unordered, the timestamps restore the LRU order
+            for timestamp, submission_id in sorted(entries):
+                self[chat].ids[submission_id] = timestamp
+
+    def track_changes(self):
+        self.tracking = True
+        for history in self.values():
+            history.changes = {}
+
+    def drain_changes(self):
+        changes = {}
+        for chat, history in self.items():
+            if history.changes:
+                for submission_id, timestamp in history.changes.items():
+                    changes[json.dumps([chat, submission_id])] = timestamp
+                history.changes = {}
+        return changes
+
+    def shell(self):
+        return SentSubmissions(self.max_count, self.max_age)
+
+    @classmethod
+    def migrate(
+        cls, sent_submissions: dict[str | int, Iterable[str]], **kwargs
+    ) -> "SentSubmissions":
+        """Converts the old chat -> list of ids mapping, oldest ids first"""
+        new = cls(**kwargs)
+        now = time.time()
+        for chat, submission_ids in sent_submissions.items():
+            submission_ids = list(submission_ids)
+            for i, submission_id in enumerate(submission_ids):
+                # distinct timestamps keep the original order when reloaded
+                new[chat].add(submission_id, now - (len(submission_ids) - i) * 1e-3)
+        return new
@@ -0,0 +1,209 @@
+from html import escape
+from html.parser import HTMLParser
+from typing import Iterator
+
+# the tags Telegram accepts with parse_mode="HTML"
+TELEGRAM_TAGS = frozenset(
+    {
+        "b",
+        "strong",
+        "i",
+        "em",
+        "u",
+        "ins",
+        "s",
+        "strike",
+        "del",
+        "span",
+        "tg-spoiler",
+        "a",
+        "code",
+        "pre",
+        "blockquote",
+    }
+)
+# the attributes kept on them, anything else is dropped
+TELEGRAM_ATTRIBUTES = {"a": ("href",), "code": ("class",), "span": ("class",)}
+SPOILER_CLASSES = {"md-spoiler-text": "tg-spoiler", "tg-spoiler": "tg-spoiler"}
+
+
+def render_tag(tag: str, attrs: list[tuple[str, str | None]]) -> str | None:
+    """The opening tag as Telegram accepts it, None if it has to be dropped"""
+    if tag not in TELEGRAM_TAGS:
+        return None
+    kept = [
+        (name, value)
+        for name, value in attrs
+        if name in TELEGRAM_ATTRIBUTES.get(tag, ()) and value is not None
+    ]
+    if tag == "span":
+        # spoilers are the only spans Telegram knows about
+        spoiler = SPOILER_CLASSES.get(dict(kept).get("class", ""))
+        if spoiler is None:
+            return None
+        kept = [("class", spoiler)]
+    return "<" + tag + "".join(f' {n}="{escape(v)}"' for n, v in kept) + ">"
+
+
+class Tokenizer(HTMLParser):
+    """Turns HTML into a flat list of tokens in one pass
+
+    Tokens are ("text", unescaped text), ("start", tag, opening tag) and
+    ("end", tag). Tags Telegram doesn't support are left out along with
+    their end tags, and so are comments; their text is kept.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tokens: list[tuple[str, ...]] = []
+        self.open_tags: list[tuple[str, bool]] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        rendered = render_tag(tag, attrs)
+        self.open_tags.append((tag, rendered is not None))
+        if rendered is not None:
+            self.tokens.append(("start", tag, rendered))
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        # <br/> and friends: nothing Telegram would accept
+        pass
+
+    def handle_endtag(self, tag: str):
+        # unmatched end tags are dropped, unclosed ones get closed here
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[i][0] == tag:
+                break
+        else:
+            return
+        while len(self.open_tags) > i:
+            open_tag, kept = self.open_tags.pop()
+            if kept:
+                self.tokens.append(("end", open_tag))
+
+    def handle_data(self, data: str):
+        if data:
+            self.tokens.append(("text", data))
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            tag, kept = self.open_tags.pop()
+            if kept:
+                self.tokens.append(("end", tag))
+
+
+def tokenize(html: str) -> list[tuple[str, ...]]:
+    tokenizer = Tokenizer()
+    tokenizer.feed(html)
+    tokenizer.close()
+    return tokenizer.tokens
+
+
+def render(tokens: list[tuple[str, ...]]) -> str:
+    parts: list[str] = []
+    for token in tokens:
+        if token[0] == "text":
+            parts.append(escape(token[1], quote=False))
+        elif token[0] == "start":
+            parts.append(token[2])
+        else:
+            parts.append(f"</{token[1]}>")
+    return "".join(parts)
+
+
+def sanitize(html: str) -> str:
+    """Keeps only the markup Telegram understands, balanced and escaped"""
+    return render(tokenize(html))
+
+
+def utf16_length(text: str) -> int:
+    """The length of text the way Telegram counts it"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_length(html: str) -> int:
+    """How long the message is once Telegram has turned the tags into entities"""
+    return sum(utf16_length(token[1]) for token in tokenize(html) if token[0] == "text")
+
+
+def iter_chunks(html: str, limit: int) -> Iterator[str]:
+    """Yields chunks of HTML with at most `limit` characters of visible text each
+
+    Tags are turned into entities by Telegram and don't count towards the
+    limit, text is measured in UTF-16 code units like Telegram does. Text is
+    cut at whitespace where possible. The tags open at a cut are closed at
+    the end of the chunk and opened again at the start of the next one, so
+    every chunk is valid HTML on its own.
+    """
+    stack: list[tuple[str, str]] = []
+    parts: list[str] = []
+    length = 0
+    has_text = False
+
+    for token in tokenize(html):
+        if token[0] == "start":
+            stack.append((token[1], token[2]))
+            parts.append(token[2])
+        elif token[0] == "end":
+            stack.pop()
+            parts.append(f"</{token[1]}>")
+        else:
+            text = token[1]
+            start = 0
+            while start < len(text):
+                end = fit_text(text, start, limit - length)
+                if end == start and not has_text:
+                    # a single character longer than the limit
+                    end += 1
+                if end > start:
+                    parts.append(escape(text[start:end], quote=False))
+                    length += utf16_length(text[start:end])
+                    has_text = has_text or not text[start:end].isspace()
+                start = end
+                if start < len(text):
+                    if has_text:
+                        yield "".join(parts) + "".join(
+                            f"</{tag}>" for tag, _ in stack[::-1]
+                        )
+                    parts = [opening for _, opening in stack]
+                    length = 0
+                    has_text = False
+                    # the whitespace at the cut is dropped
+                    while start < len(text) and text[start].isspace():
+                        start += 1
+    if has_text:
+        yield "".join(parts)
+
+
+def split_html(html: str, limit: int) -> list[str]:
+    return list(iter_chunks(html, limit))
+
+
+def truncate_html(html: str, limit: int, placeholder: str = "…") -> str:
+    """Shortens HTML to at most `limit` characters of visible text, the
+    placeholder included, keeping the tags balanced"""
+    if limit <= 0:
+        return ""
+    if visible_length(html) <= limit:
+        return html
+    chunks = iter_chunks(html, max(1, limit - utf16_length(placeholder)))
+    return next(chunks, "") + placeholder
+
+
+def fit_text(text: str, start: int, available: int) -> int:
+    """Where to cut `text` so that what follows `start` fits in `available`,
+    preferably at some whitespace"""
+    if available <= 0:
+        return start
+    end = min(len(text), start + available)
+    # characters outside the BMP are 2 long, they're dropped from the end
+    # by their own length until the rest fits
+    excess = utf16_length(text[start:end]) - available
+    while excess > 0:
+        end -= 1
+        excess -= 2 if ord(text[end]) > 0xFFFF else 1
+    if end == len(text):
+        return end
+    # the last whitespace that fits, unless that leaves the chunk mostly empty
+    space = max(text.rfind(" ", start, end + 1), text.rfind("\n", start, end + 1))
+    return space if space > start + (end - start) // 2 else end